@@ -0,0 +1,79 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Compare the row-at-a-time staging insert with the bulk loader strategies
+against a local SQLite database shaped like the iReady staging tables.
+
+Run from the graph_api directory:
+    python benchmarks/bench_bulk_loader.py [rows] [chunk_size]
+
+SQLite has no table-valued parameters, so only the executemany and
+values strategies are measured here. On SQL Server the executemany
+strategy also turns on pyodbc fast_executemany, which removes the per-row
+network round trip that dominates the original insert loop.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import sqlalchemy as sa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from graph_connector_app.bulk_loader import BulkLoader  # noqa: E402
+
+COLUMNS = 66
+
+
+def staging_table(metadata):
+    # Same width and mix of types as AI.MathIreadyStaging
+    columns = []
+    for column in range(COLUMNS):
+        if column % 3:
+            columns.append(sa.Column(f'Column{column}', sa.String(100)))
+        else:
+            columns.append(sa.Column(f'Column{column}', sa.Integer))
+    return sa.Table('MathIreadyStaging', metadata, *columns)
+
+
+def synthetic_rows(rows):
+    return [[f'text {row}-{column}' if column % 3 else row * column for column in range(COLUMNS)]
+            for row in range(rows)]
+
+
+def row_at_a_time(connection, table, rows):
+    # The insert loop the ingestion views used before the bulk loader
+    start = time.perf_counter()
+    for row in rows:
+        connection.execute(table.insert().values(row))
+    return time.perf_counter() - start
+
+
+def main():
+    row_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    rows = synthetic_rows(row_count)
+
+    engine = sa.create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench_bulk.sqlite3')}")
+    metadata = sa.MetaData()
+    table = staging_table(metadata)
+    metadata.create_all(engine)
+
+    with engine.connect() as connection:
+        print(f'{row_count} rows x {COLUMNS} columns')
+
+        seconds = row_at_a_time(connection, table, rows)
+        print(f'  row-at-a-time  {seconds:7.2f} s  {row_count / seconds:10,.0f} rows/s')
+
+        for strategy in ('executemany', 'values'):
+            connection.execute(table.delete())
+            result = BulkLoader(connection, table, strategy, chunk_size).load(rows)
+            count = connection.execute(sa.select([sa.func.count()]).select_from(table)).scalar()
+            print(f'  {strategy:<14} {result.seconds:7.2f} s  {result.rows_per_second:10,.0f} rows/s'
+                  f'  ({count} rows in table)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Compare the workbook usedRange REST path with the download-and-parse
+path for the same workbooks, served from a local stub in place of Graph.
+
+Run from the graph_api directory:
+    python benchmarks/bench_xlsx_ingest.py [workbook.xlsx ...]
+
+Without arguments a synthetic iReady-sized workbook is generated.
+"""
+
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Keep the benchmark away from the real worksheet cache
+os.environ['WORKSHEET_CACHE_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench_cache.sqlite3')
+
+from graph_connector_app import graph_helper  # noqa: E402
+from graph_connector_app.xlsx_reader import read_worksheet_values  # noqa: E402
+
+FIXTURES = {}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        # /drive/items/<id>/content or /drive/items/<id>/workbook/...
+        item_id = self.path.split('/items/', 1)[1].split('/', 1)[0]
+        content, used_range = FIXTURES[item_id]
+        if '/content' in self.path:
+            body = content
+            content_type = 'application/octet-stream'
+        else:
+            body = used_range
+            content_type = 'application/json'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def synthetic_workbook(rows=20000, columns=66):
+    # A minimal xlsx with shared strings, laid out like an iReady export
+    strings = {}
+    sheet_rows = []
+    for row in range(rows + 1):
+        cells = []
+        for column in range(columns):
+            if row == 0:
+                value = f'Column {column}'
+            elif column % 3:
+                value = f'School {row % 40}' if column % 2 else f'text {row}-{column}'
+            else:
+                value = 45500 + row % 200 if column == 24 else row * column
+            reference = f'{column_letter(column + 1)}{row + 1}'
+            if isinstance(value, str):
+                index = strings.setdefault(value, len(strings))
+                cells.append(f'<c r="{reference}" t="s"><v>{index}</v></c>')
+            else:
+                cells.append(f'<c r="{reference}"><v>{value}</v></c>')
+        sheet_rows.append(f'<row r="{row + 1}">{"".join(cells)}</row>')
+
+    main = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+    rel = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as package:
+        package.writestr('xl/workbook.xml',
+            f'<workbook xmlns="{main}" xmlns:r="{rel}"><sheets>'
+            '<sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>')
+        package.writestr('xl/_rels/workbook.xml.rels',
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f'<Relationship Id="rId1" Type="{rel}/worksheet" Target="worksheets/sheet1.xml"/>'
+            '</Relationships>')
+        package.writestr('xl/sharedStrings.xml',
+            f'<sst xmlns="{main}">' + ''.join(f'<si><t>{escape(text)}</t></si>' for text in strings) + '</sst>')
+        package.writestr('xl/worksheets/sheet1.xml',
+            f'<worksheet xmlns="{main}"><sheetData>{"".join(sheet_rows)}</sheetData></worksheet>')
+    return buffer.getvalue()
+
+
+def column_letter(number):
+    letters = ''
+    while number:
+        number, remainder = divmod(number - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def load_fixture(item_id, content):
+    # The REST payload is what Graph would return for the same sheet
+    values = read_worksheet_values(content)
+    FIXTURES[item_id] = (content, json.dumps({'values': values}).encode('utf8'))
+    return values
+
+
+def timed(fetch, *args):
+    start = time.perf_counter()
+    values = fetch(*args)['values']
+    return values, time.perf_counter() - start
+
+
+def main():
+    paths = sys.argv[1:]
+    if paths:
+        workbooks = {str(index): open(path, 'rb').read() for index, path in enumerate(paths)}
+    else:
+        workbooks = {'synthetic': synthetic_workbook()}
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    graph_helper.GRAPH_URL = f'http://127.0.0.1:{server.server_port}'
+
+    for item_id, content in workbooks.items():
+        expected = load_fixture(item_id, content)
+        rest_values, rest_time = timed(graph_helper.get_file_data, 'stub', '/drive', item_id, 'Sheet1')
+        download_values, download_time = timed(graph_helper.get_file_content_data, 'stub', '/drive', item_id, 'Sheet1')
+
+        print(f'{item_id}: {len(expected)} rows, xlsx {len(content) / 1024:.0f} KiB, '
+              f'usedRange JSON {len(FIXTURES[item_id][1]) / 1024:.0f} KiB')
+        print(f'  rest      {rest_time * 1000:9.1f} ms')
+        print(f'  download  {download_time * 1000:9.1f} ms')
+        print(f'  identical rows: {rest_values == download_values}')
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Compare request throughput of the WSGI and ASGI deployments of the app
+under the same concurrent load.
+
+Start both deployments from the graph_api directory, e.g.
+    gunicorn graph_main_app.wsgi:application --bind 127.0.0.1:8000
+    gunicorn graph_main_app.asgi:application -k uvicorn.workers.UvicornWorker --bind 127.0.0.1:8001
+with the same worker count, then run:
+    python benchmarks/load_test_asgi.py http://127.0.0.1:8000 http://127.0.0.1:8001 \\
+        [--path /get_districts?ai_year_selection=2024-2025%20Data] [--requests 500] [--concurrency 50]
+
+Pick a path whose response needs a Graph round trip (e.g. a file_data
+page, or get_districts with LISTING_CACHE_TTL=0) to measure the I/O-bound
+case the async views are for.
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+async def run_load(base_url, path, requests, concurrency):
+    # Send requests GETs with at most concurrency in flight; return the
+    # elapsed seconds, per-request latencies in ms and the failure count
+    latencies = []
+    failures = 0
+    queue = asyncio.Queue()
+    for _ in range(requests):
+        queue.put_nowait(None)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        async def worker():
+            nonlocal failures
+            while not queue.empty():
+                queue.get_nowait()
+                start = time.perf_counter()
+                try:
+                    response = await client.get(path)
+                    if response.status_code >= 400:
+                        failures += 1
+                except httpx.HTTPError:
+                    failures += 1
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        return time.perf_counter() - start, latencies, failures
+
+
+def report(label, elapsed, latencies, failures):
+    latencies = sorted(latencies)
+    print(f'{label:<6} {len(latencies) / elapsed:8.1f} req/s   '
+          f'median {statistics.median(latencies):8.1f} ms   '
+          f'p95 {latencies[int(len(latencies) * 0.95) - 1]:8.1f} ms   '
+          f'failed {failures}')
+
+
+def main():
+    arguments = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arguments.add_argument('wsgi_url')
+    arguments.add_argument('asgi_url')
+    arguments.add_argument('--path', default='/get_picker')
+    arguments.add_argument('--requests', type=int, default=500)
+    arguments.add_argument('--concurrency', type=int, default=50)
+    options = arguments.parse_args()
+
+    print(f'{options.requests} x GET {options.path}, {options.concurrency} concurrent')
+    for label, base_url in (('WSGI', options.wsgi_url), ('ASGI', options.asgi_url)):
+        # One unmeasured request so caches and connections are warm for both
+        httpx.get(base_url + options.path, timeout=120)
+        report(label, *asyncio.run(run_load(base_url, options.path, options.requests, options.concurrency)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,6 @@
 from django.contrib import admin
 
 # Register your models here.
+from graph_connector_app.models import IngestJob
+
+admin.site.register(IngestJob)
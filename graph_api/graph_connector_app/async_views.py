@@ -0,0 +1,100 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+# Async versions of the Graph-bound views, routed in place of the ones in
+# views.py when the app is served over ASGI (see urls.py). Sessions, the
+# ORM and template rendering are synchronous in Django 4.1, so those
+# steps go through sync_to_async while Graph calls are awaited directly.
+
+from asgiref.sync import sync_to_async
+from dateutil import parser
+from django.http import HttpResponseRedirect, JsonResponse
+from django.shortcuts import render
+from django.urls import reverse
+from graph_connector_app import graph_async, views
+from graph_connector_app.auth_helper import get_token, get_token_for_app
+from graph_connector_app.listing_cache import get_listing_cache
+
+_initialize_context = sync_to_async(views.initialize_context)
+_render = sync_to_async(render)
+
+async def _cached_listing(directory, load):
+    # Cache hits are served without leaving the event loop; a miss loads
+    # the listing from the drive mirror on a worker thread
+    listing = get_listing_cache().peek(directory)
+    if listing is None:
+        listing = await sync_to_async(get_listing_cache().get, thread_sensitive=False)(directory, load)
+    return listing
+
+async def calendar(request):
+    context = await _initialize_context(request)
+    user = context['user']
+    if not user['is_authenticated']:
+        return HttpResponseRedirect(reverse('signin'))
+
+    start, end = views._calendar_week(user)
+
+    token = await sync_to_async(get_token)(request)
+
+    events = []
+    async for event in graph_async.get_calendar_events(
+        token,
+        start.isoformat(timespec='seconds'),
+        end.isoformat(timespec='seconds'),
+        user['timeZone']):
+        # Convert the ISO 8601 date times to a datetime object
+        # This allows the Django template to format the value nicely
+        event['start']['dateTime'] = parser.parse(event['start']['dateTime'])
+        event['end']['dateTime'] = parser.parse(event['end']['dateTime'])
+        events.append(event)
+
+    if events:
+        context['events'] = events
+
+    return await _render(request, 'graph_connector_app/calendar.html', context)
+
+async def get_picker(request):
+    context = await _initialize_context(request)
+
+    context['ai_years'] = await _cached_listing(views.ai_root_directory,
+                                                lambda: views._list_years(views.ai_root_directory))
+
+    return await _render(request, 'graph_connector_app/ai_folderpicker.html', context)
+
+async def get_districts(request):
+    ai_year = request.GET.get('ai_year_selection')
+
+    directory = 'root:/IT Solutions/' + ai_year + ':/children'
+
+    district_list = await _cached_listing(directory, lambda: views._list_districts(directory))
+
+    response_data = {
+        "districts" : district_list
+    }
+
+    return JsonResponse(response_data)
+
+async def ai_files(request):
+    context = await _initialize_context(request)
+
+    directory = 'root:/IT Solutions/' + request.POST.get('year') + '/' + request.POST.get('district') + ':/children'
+
+    # Listing and worksheet name lookups share the sync mirror and $batch
+    # code, so they run on a worker thread
+    files = await sync_to_async(views._list_files, thread_sensitive=False)(directory)
+    if files:
+        context['ai_files'] = files
+
+    context['ai_directory_path'] = directory
+
+    return await _render(request, 'graph_connector_app/ai_files.html', context)
+
+async def file_data(request, file_id, worksheet_name):
+    context = await _initialize_context(request)
+
+    token = await sync_to_async(get_token_for_app, thread_sensitive=False)()
+
+    context['file_data'] = (await graph_async.get_file_data(token,views.drive,file_id,worksheet_name))['values']
+    context['file_name'] = request.GET['file_name']
+
+    return await _render(request, 'graph_connector_app/file_data.html', context)
@@ -1,25 +1,84 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import threading
+import time
+
 import yaml
 import msal
 
+from graph_connector_app.token_cache import cached_access_token, get_token_cache_store
+from graph_connector_app.token_refresher import get_token_refresher
+
 # Load the oauth_settings.yml file
 stream = open('oauth_settings.yml', 'r', encoding='utf8')
 settings = yaml.load(stream, yaml.SafeLoader)
 
+# Renew the app-only token this many seconds before it expires
+APP_TOKEN_EXPIRY_MARGIN = 300
+
+_app_client = None
+_app_client_lock = threading.Lock()
+_app_token = None
+_app_token_lock = threading.Lock()
+
+# account -> (token cache, client) so each signed-in account reuses one client
+_user_clients = {}
+_user_clients_lock = threading.Lock()
+
+# Stop refreshing a user's token in the background once they have made
+# no request for this many seconds
+ACCOUNT_IDLE_TIMEOUT = 3600
+
+# account -> time of the account's last get_token call
+_account_last_used = {}
+
+def get_session_account(request):
+    # The session only holds the signed-in account's id; its tokens live
+    # in the shared token cache store
+    account = request.session.get('token_account')
+
+    # Move a token cache from a session created before the shared store
+    if account is None and request.session.get('token_cache'):
+        cache = msal.SerializableTokenCache()
+        cache.deserialize(request.session.pop('token_cache'))
+        account = _adopt_cache(request, cache)
+
+    return account
+
+def _adopt_cache(request, cache):
+    accounts = get_msal_app(cache).get_accounts()
+    if not accounts:
+        return None
+
+    account = accounts[0]['home_account_id']
+    cache.has_state_changed = True
+    get_token_cache_store().save(account, cache)
+    request.session['token_account'] = account
+    return account
+
 def load_cache(request):
-    # Check for a token cache in the session
-    cache = msal.SerializableTokenCache()
-    if request.session.get('token_cache'):
-        cache.deserialize(request.session['token_cache'])
+    # Load the signed-in account's token cache from the shared store
+    account = get_session_account(request)
+    if account is None:
+        return msal.SerializableTokenCache()
 
-    return cache
+    return get_token_cache_store().load(account)
 
 def save_cache(request, cache):
-    # If cache has changed, persist back to session
-    if cache.has_state_changed:
-        request.session['token_cache'] = cache.serialize()
+    # If cache has changed, persist the changed entries to the shared store
+    account = request.session.get('token_account')
+    if account is not None:
+        get_token_cache_store().save(account, cache)
+
+def get_user_msal_app(account, cache):
+    # Reuse the client built for this account while its cache is the same
+    with _user_clients_lock:
+        cached = _user_clients.get(account)
+        if cached is None or cached[0] is not cache:
+            cached = (cache, get_msal_app(cache))
+            _user_clients[account] = cached
+        return cached[1]
 
 def get_msal_app(cache=None):
     # Initialize the MSAL confidential client
@@ -41,14 +100,14 @@ def get_sign_in_flow():
 
 # Method to exchange auth code for access token
 def get_token_from_code(request):
-    cache = load_cache(request)
+    cache = msal.SerializableTokenCache()
     auth_app = get_msal_app(cache)
 
     # Get the flow saved in session
     flow = request.session.pop('auth_flow', {})
 
     result = auth_app.acquire_token_by_auth_code_flow(flow, request.GET)
-    save_cache(request, cache)
+    _adopt_cache(request, cache)
 
     return result
 
@@ -65,41 +124,127 @@ def store_user(request, user):
     }
 
 def get_token(request):
-    cache = load_cache(request)
-    auth_app = get_msal_app(cache)
+    account = get_session_account(request)
+    if account is None:
+        return None
+
+    # Most requests are served from memory: while the account has an
+    # unexpired access token no lock is taken and the store is read at
+    # most every recheck seconds
+    store = get_token_cache_store()
+    result = cached_access_token(store.load(account), account, settings['scopes'])
+
+    if result is None:
+        # Under the account's lock, so only one worker redeems its refresh
+        # token and the others pick up the tokens it saved
+        with store.locked(account) as cache:
+            auth_app = get_user_msal_app(account, cache)
+
+            accounts = auth_app.get_accounts()
+            if not accounts:
+                return None
+            result = auth_app.acquire_token_silent(
+                settings['scopes'],
+                account=accounts[0])
+
+    if result is not None and 'access_token' in result:
+        # Keep this account's token renewed ahead of expiry while it is active
+        if account not in _account_last_used:
+            _schedule_account_refresh(account, result)
+        _account_last_used[account] = time.time()
+
+    return result['access_token'] if result is not None else None
 
-    accounts = auth_app.get_accounts()
-    if accounts:
+def _schedule_account_refresh(account, result):
+    now = time.time()
+    get_token_refresher().schedule(('account', account), now,
+        now + int(result.get('expires_in', 3600)),
+        lambda: _refresh_account_token(account))
+
+def _refresh_account_token(account):
+    # Runs on the refresher thread
+    if time.time() - _account_last_used.get(account, 0) > ACCOUNT_IDLE_TIMEOUT:
+        _account_last_used.pop(account, None)
+        with _user_clients_lock:
+            _user_clients.pop(account, None)
+        return
+
+    with get_token_cache_store().locked(account) as cache:
+        auth_app = get_user_msal_app(account, cache)
+        accounts = auth_app.get_accounts()
         result = auth_app.acquire_token_silent(
             settings['scopes'],
-            account=accounts[0])
+            account=accounts[0],
+            force_refresh=True) if accounts else None
+
+    if not accounts:
+        _account_last_used.pop(account, None)
+        return
 
-        save_cache(request, cache)
+    if result is None or 'access_token' not in result:
+        raise RuntimeError(result.get('error_description') if result else 'No refresh token available')
 
-        return result['access_token'] if result is not None else None
+    _schedule_account_refresh(account, result)
 
 def remove_user_and_token(request):
     if 'token_cache' in request.session:
         del request.session['token_cache']
 
+    if 'token_account' in request.session:
+        account = request.session.pop('token_account')
+        get_token_cache_store().remove(account)
+        with _user_clients_lock:
+            _user_clients.pop(account, None)
+        _account_last_used.pop(account, None)
+        get_token_refresher().unschedule(('account', account))
+
     if 'user' in request.session:
         del request.session['user']
 
 
 # CUSTOM METHOD TO GET TOKEN USING CLIENT SECRET ONLY, NO USER LOGIN CREDENTIALS USED
-def get_token_for_app(request):
-
-    cache = load_cache(request)
-
-    auth_app = msal.ConfidentialClientApplication(settings['app_id'],
-        authority=settings['authority'],
-        client_credential=settings['app_secret'],
-        token_cache=cache)
-    
-    result = auth_app.acquire_token_silent(settings['app_scope'], account=None)
-    if not result:
-        result = auth_app.acquire_token_for_client(scopes=settings['app_scope'])
-
-    save_cache(request, cache)
-
-    return result['access_token'] if result is not None else None
+def get_app_client():
+    # Process-wide confidential client for the app identity
+    # It keeps its own in-memory token cache, separate from user sessions
+    global _app_client
+    if _app_client is None:
+        with _app_client_lock:
+            if _app_client is None:
+                _app_client = get_msal_app(msal.TokenCache())
+    return _app_client
+
+def get_token_for_app(request=None):
+    # The app token is shared by every request and session, so request is
+    # no longer used; it is accepted so existing callers keep working
+    token = _app_token
+    if token is not None and token['expires_at'] - APP_TOKEN_EXPIRY_MARGIN > time.time():
+        return token['access_token']
+
+    return _refresh_app_token()
+
+def _refresh_app_token(force=False):
+    global _app_token
+    with _app_token_lock:
+        # Another thread may have refreshed while we waited for the lock
+        token = _app_token
+        if not force and token is not None and token['expires_at'] - APP_TOKEN_EXPIRY_MARGIN > time.time():
+            return token['access_token']
+
+        result = get_app_client().acquire_token_for_client(scopes=settings['app_scope'])
+        if not result or 'access_token' not in result:
+            if force:
+                raise RuntimeError(result.get('error_description') if result else 'App token request failed')
+            return None
+
+        issued_at = time.time()
+        token = {
+            'access_token': result['access_token'],
+            'expires_at': issued_at + int(result.get('expires_in', 3600))
+        }
+        _app_token = token
+
+    # Renew in the background so requests never wait on the token endpoint
+    get_token_refresher().schedule(('app',), issued_at, token['expires_at'],
+        lambda: _refresh_app_token(force=True))
+
+    return token['access_token']
@@ -0,0 +1,138 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import copy
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+
+from graph_connector_app.auth_helper import get_token_for_app
+from graph_connector_app.bulk_loader import CheckpointedReplace, table_lock
+from graph_connector_app.datasets import DATASETS, route_files
+from graph_connector_app.graph_helper import get_filelist, resolve_worksheet_names
+from graph_connector_app.ingest_pipeline import PipelineCounts, ingest_rows
+from graph_connector_app.sqlalchemy_models import sql_models as sm
+
+logger = logging.getLogger(__name__)
+
+# Worker processes a bulk ingest spreads districts across. Override with
+# the BULK_INGEST_PROCESSES environment variable.
+BULK_INGEST_PROCESSES = int(os.environ.get('BULK_INGEST_PROCESSES', str(os.cpu_count() or 1)))
+AI_ROOT = 'root:/IT Solutions'
+
+def discover_districts(token, drive, years):
+    # [(year, district, directory)] for every district folder of each year
+    districts = []
+    for year in years:
+        for item in get_filelist(token,drive,f'{AI_ROOT}/{year}:/children'):
+            if 'folder' in item:
+                districts.append((year, item['name'], f"{AI_ROOT}/{year}/{item['name']}:/children"))
+    return districts
+
+def bulk_ingest(drive, years, names=None, processes=None, progress=None):
+    # Ingest every district folder of the given academic years into the
+    # staging tables of the named datasets (all by default). Districts are
+    # fetched, coerced, filtered and written in a pool of worker
+    # processes, each streaming its rows into the datasets' shadow tables
+    # with one checkpoint per district (see CheckpointedReplace); the
+    # shadows are switched in once every district has finished, so the
+    # tables end up holding every district that succeeded. progress, if
+    # given, is called with a copy of the running summary as districts
+    # finish. Returns {'districts': {...}, 'datasets': {...}}.
+    start = time.perf_counter()
+    names = list(names or DATASETS)
+    districts = discover_districts(get_token_for_app(), drive, years)
+    summary = {'districts': {}, 'datasets': {}}
+    replaces = {name: CheckpointedReplace(DATASETS[name].table) for name in names}
+    loaded = {name: {'rows_loaded': 0, 'districts': 0} for name in names}
+
+    def report():
+        if progress is not None:
+            progress(copy.deepcopy(summary))
+
+    with sm.db.connect() as connection, ExitStack() as locks:
+        for name in names:
+            locks.enter_context(table_lock(connection, replaces[name].table))
+            # Districts have no cTag to check, so a bulk ingest always
+            # starts its shadow tables over
+            replaces[name].begin(connection, [])
+
+        # spawn, because the web process forking with threads running is unsafe
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=processes or BULK_INGEST_PROCESSES, mp_context=context) as pool:
+            futures = {}
+            for year, district, directory in districts:
+                label = f'{year}/{district}'
+                futures[pool.submit(_load_district, drive, label, directory, names)] = label
+            for future in as_completed(futures):
+                label = futures[future]
+                try:
+                    results = future.result()
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.exception('Bulk ingest of %s failed', label)
+                    summary['districts'][label] = {'status': 'failed', 'error': repr(exc)}
+                else:
+                    failed = False
+                    for name, counts in results.items():
+                        if 'error' in counts:
+                            failed = True
+                            continue
+                        loaded[name]['rows_loaded'] += counts['rows_loaded']
+                        loaded[name]['districts'] += 1
+                    summary['districts'][label] = {
+                        'status': 'failed' if failed else 'succeeded',
+                        'datasets': results,
+                    }
+                report()
+
+        # A dataset no district loaded rows for is left as it is
+        for name in names:
+            if not loaded[name]['districts']:
+                continue
+            switch_start = time.perf_counter()
+            replaces[name].finish(connection)
+            summary['datasets'][name] = dict(loaded[name], seconds=time.perf_counter() - switch_start)
+            report()
+
+    summary['seconds'] = time.perf_counter() - start
+    logger.info('Bulk ingest of %s: %s districts, %s failed', ', '.join(years), len(districts),
+                sum(1 for result in summary['districts'].values() if result['status'] == 'failed'))
+    return summary
+
+def _load_district(drive, label, directory, names):
+    # Runs in a worker process: write the rows of the district's files
+    # into each dataset's shadow table, one transaction and checkpoint per
+    # dataset. Returns {dataset name: counts dict}, or {'error': ...} for
+    # a dataset whose load failed and was rolled back.
+    datasets = [DATASETS[name] for name in names]
+    routed = route_files(get_token_for_app(), drive, directory, datasets)
+    resolve_worksheet_names(get_token_for_app(),drive,[file for files in routed.values() for file in files])
+    checkpoint = {'id': label, 'cTag': None, 'FileName': label}
+
+    results = {}
+    for dataset in datasets:
+        if not routed[dataset.name]:
+            continue
+        counts = PipelineCounts()
+        start = time.perf_counter()
+        replace = CheckpointedReplace(dataset.table)
+        rows = ingest_rows(get_token_for_app, drive, routed[dataset.name], dataset.table, dataset.prefix,
+                           counts, dataset.drop_rules)
+        try:
+            with sm.db.connect() as connection:
+                try:
+                    result = replace.load_file(connection, checkpoint, rows)
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.exception('Loading %s of %s failed', dataset.name, label)
+                    replace.record_failure(connection, checkpoint)
+                    results[dataset.name] = {'error': repr(exc)}
+                    continue
+        finally:
+            rows.close()
+        counts.rows_loaded = result.rows
+        counts.seconds = time.perf_counter() - start
+        results[dataset.name] = counts.as_dict()
+    return results
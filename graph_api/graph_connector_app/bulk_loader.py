@@ -0,0 +1,628 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import hashlib
+import itertools
+import logging
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import sqlalchemy as sa
+
+logger = logging.getLogger(__name__)
+
+# Rows written per round trip and the default insert strategy.
+# Override with the BULK_CHUNK_SIZE and BULK_LOAD_STRATEGY environment variables.
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', '5000'))
+BULK_LOAD_STRATEGY = os.environ.get('BULK_LOAD_STRATEGY', 'auto')
+
+# How replace_table_rows swaps in new staging data: 'swap' loads a shadow
+# table and switches its rows into place, 'truncate' empties the live table and
+# loads it directly, 'merge' writes only the rows whose content hash
+# changed since the last load. Override with the STAGING_LOAD_MODE
+# environment variable.
+STAGING_LOAD_MODE = os.environ.get('STAGING_LOAD_MODE', 'swap')
+SHADOW_SUFFIX = '_Load'
+CHECKPOINT_SUFFIX = '_Checkpoint'
+ROW_HASH_SUFFIX = '_RowHash'
+DELTA_SUFFIX = '_Delta'
+
+# Seconds a load waits for another load of the same staging table to
+# finish. Override with the STAGING_LOCK_TIMEOUT environment variable.
+STAGING_LOCK_TIMEOUT = int(os.environ.get('STAGING_LOCK_TIMEOUT', '1800'))
+
+# SQL Server caps a statement at 2100 parameters and a VALUES list at 1000 rows
+MAX_PARAMETERS = 2100
+MAX_VALUES_ROWS = 1000
+
+class TableLockError(RuntimeError):
+    """Raised when another load of the same staging table holds its lock too long"""
+
+class LoadResult:
+    """Row count and throughput of a bulk load
+
+    For merge loads rows counts the rows written and changes holds the
+    inserted, updated, deleted and unchanged totals.
+    """
+
+    def __init__(self, table_name, strategy, rows, seconds, changes=None):
+        self.table_name = table_name
+        self.strategy = strategy
+        self.rows = rows
+        self.seconds = seconds
+        self.changes = changes
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else float(self.rows)
+
+    def __str__(self):
+        return (f'{self.table_name}: {self.rows} rows in {self.seconds:.2f}s '
+                f'({self.rows_per_second:,.0f} rows/s, {self.strategy})')
+
+class BulkLoader:
+    """Write positional rows into a table in chunks with a pluggable strategy
+
+    Strategies:
+        executemany  one parameterised INSERT run over the whole chunk;
+                     on SQL Server the pyodbc cursor uses fast_executemany
+        values       multi-row INSERT ... VALUES statements, for drivers
+                     without a fast executemany
+        tvp          SQL Server table-valued parameter; needs a table type
+                     named <table>Type in the table's schema
+        auto         tvp is opt-in, so this is executemany
+    """
+
+    def __init__(self, connection, table, strategy=None, chunk_size=None):
+        strategy = strategy or BULK_LOAD_STRATEGY
+        if strategy == 'auto':
+            strategy = 'executemany'
+        if strategy not in STRATEGIES:
+            raise ValueError(f'Unknown bulk load strategy: {strategy}')
+
+        self.connection = connection
+        self.table = table
+        self.strategy = strategy
+        self.chunk_size = chunk_size or BULK_CHUNK_SIZE
+        self.column_keys = [column.key for column in table.columns]
+
+    def load(self, rows):
+        # rows is any iterable of lists in table column order; it is
+        # consumed chunk by chunk, so a generator keeps memory bounded
+        start = time.perf_counter()
+
+        trans = self.connection.begin()
+        try:
+            total = self.write(rows)
+            trans.commit()
+        except Exception:
+            trans.rollback()
+            raise
+
+        result = LoadResult(self.table.fullname, self.strategy, total, time.perf_counter() - start)
+        logger.info('%s', result)
+        return result
+
+    def write(self, rows):
+        # As load, inside a transaction the caller has begun; returns the
+        # number of rows written
+        write = STRATEGIES[self.strategy]
+        total = 0
+        for chunk in _chunks(rows, self.chunk_size):
+            write(self, chunk)
+            total += len(chunk)
+        return total
+
+    def _as_dicts(self, chunk):
+        return [dict(zip(self.column_keys, row)) for row in chunk]
+
+@contextmanager
+def table_lock(connection, table, timeout=None):
+    # Hold an exclusive SQL Server application lock on table for the
+    # session, so loads of one staging table from different jobs, threads
+    # or processes take turns with its shadow, delta and checkpoint
+    # tables. Re-entrant on the same connection; a no-op elsewhere.
+    if connection.dialect.name != 'mssql':
+        yield
+        return
+
+    timeout = STAGING_LOCK_TIMEOUT if timeout is None else timeout
+    resource = f'staging_load:{table.fullname}'
+    trans = connection.begin()
+    status = connection.execute(sa.text(
+        "SET NOCOUNT ON; DECLARE @status int; "
+        "EXEC @status = sp_getapplock @Resource = :resource, @LockMode = 'Exclusive', "
+        "@LockOwner = 'Session', @LockTimeout = :timeout; SELECT @status"),
+        {'resource': resource, 'timeout': timeout * 1000}).scalar()
+    trans.commit()
+    if status is None or status < 0:
+        raise TableLockError(f'{table.fullname} is being loaded by another job (sp_getapplock returned {status})')
+
+    try:
+        yield
+    finally:
+        try:
+            trans = connection.begin()
+            connection.execute(sa.text(
+                "EXEC sp_releaseapplock @Resource = :resource, @LockOwner = 'Session'"),
+                {'resource': resource})
+            trans.commit()
+        except Exception:  # pylint: disable=broad-except
+            # The lock goes with the session if the connection is broken
+            logger.exception('Could not release the load lock on %s', table.fullname)
+
+def replace_table_rows(connection, table, rows, mode=None, **loader_options):
+    # Replace the contents of table with rows and return the LoadResult.
+    # In swap and merge mode readers see the old rows until the new ones
+    # are all written, and a failed load leaves the table untouched.
+    # Loads of the same table wait for each other (see table_lock).
+    with table_lock(connection, table):
+        return _replace_table_rows(connection, table, rows, mode, loader_options)
+
+def _replace_table_rows(connection, table, rows, mode, loader_options):
+    mode = mode or STAGING_LOAD_MODE
+    preparer = connection.dialect.identifier_preparer
+
+    if mode not in ('truncate', 'swap', 'merge'):
+        raise ValueError(f'Unknown staging load mode: {mode}')
+    if mode != 'truncate' and connection.dialect.name != 'mssql':
+        raise ValueError(f'The {mode} staging load mode needs SQL Server')
+
+    if mode == 'merge':
+        return _merge_table_rows(connection, table, rows, loader_options)
+
+    if connection.dialect.name == 'mssql':
+        # A full reload leaves any stored row hashes stale, and any
+        # checkpointed load half done in the shadow table can't resume
+        _reset_row_hashes(connection, table)
+        _reset_checkpoints(connection, table)
+
+    if mode == 'truncate':
+        trans = connection.begin()
+        connection.execute(f'TRUNCATE TABLE {preparer.format_table(table)}')
+        trans.commit()
+        return BulkLoader(connection, table, **loader_options).load(rows)
+
+    shadow = table.to_metadata(sa.MetaData(), name=table.name + SHADOW_SUFFIX)
+    _prepare_shadow(connection, table, shadow)
+    result = BulkLoader(connection, shadow, **loader_options).load(rows)
+    _switch_tables(connection, table, shadow)
+    return result
+
+def _prepare_shadow(connection, table, shadow):
+    # Recreate the shadow, empty, from the live table's definition as the
+    # database has it: columns, defaults, primary key and indexes, which
+    # ALTER TABLE ... SWITCH needs to match. It is rebuilt on every load
+    # so it follows any change to the live table.
+    preparer = connection.dialect.identifier_preparer
+    live = sa.Table(table.name, sa.MetaData(), schema=table.schema,
+                    autoload_with=connection, resolve_fks=False)
+    definition = _shadow_definition(live, shadow.name)
+
+    trans = connection.begin()
+    try:
+        connection.execute(sa.text(
+            f"IF OBJECT_ID(:shadow, N'U') IS NOT NULL DROP TABLE {preparer.format_table(shadow)}"),
+            {'shadow': shadow.fullname})
+        definition.create(connection)
+        trans.commit()
+    except Exception:
+        trans.rollback()
+        raise
+
+def _shadow_definition(live, name):
+    # A copy of live named name. Constraint names are unique per schema,
+    # so they get the shadow suffix; foreign keys are left off since
+    # nothing reads the shadow before it is switched in.
+    definition = live.to_metadata(sa.MetaData(), name=name)
+    for constraint in list(definition.constraints):
+        if isinstance(constraint, sa.ForeignKeyConstraint):
+            definition.constraints.discard(constraint)
+        elif constraint.name:
+            constraint.name = f'{constraint.name}{SHADOW_SUFFIX}'
+    for column in definition.columns:
+        column.foreign_keys.clear()
+    definition.foreign_keys.clear()
+    return definition
+
+def _switch_tables(connection, table, shadow, statements=()):
+    # Empty the live table and switch the shadow's rows into it in one
+    # transaction. SWITCH only moves metadata, and the live table keeps
+    # its own definition, permissions and dependencies. Any statements
+    # given are run in the same transaction.
+    preparer = connection.dialect.identifier_preparer
+    trans = connection.begin()
+    try:
+        connection.execute(f'TRUNCATE TABLE {preparer.format_table(table)}')
+        connection.execute(f'ALTER TABLE {preparer.format_table(shadow)} SWITCH TO {preparer.format_table(table)}')
+        for statement in statements:
+            connection.execute(statement)
+        trans.commit()
+    except Exception:
+        trans.rollback()
+        raise
+
+class CheckpointedReplace:
+    """Replace a staging table file by file so a failed run can resume
+
+    Each file's rows are written to the shadow table in one transaction
+    together with the file's row in <table>_Checkpoint (item id, cTag,
+    rows written, status). begin() works out which files a previous run
+    already committed; finish() switches the shadow in and clears the
+    checkpoints. SQL Server only, like the swap load mode. Hold
+    table_lock from begin() to finish().
+    """
+
+    COMPLETE = 'complete'
+    FAILED = 'failed'
+
+    def __init__(self, table, **loader_options):
+        self.table = table
+        self.shadow = table.to_metadata(sa.MetaData(), name=table.name + SHADOW_SUFFIX)
+        self.checkpoints = _checkpoint_table(table)
+        self.loader_options = loader_options
+
+    def begin(self, connection, files):
+        # Return the files still to load. A previous run is resumed only if
+        # every file it committed is in files with an unchanged cTag;
+        # otherwise the shadow table and checkpoints start over.
+        trans = connection.begin()
+        self.checkpoints.create(connection, checkfirst=True)
+        trans.commit()
+
+        committed = {row.ItemId: row.CTag for row in connection.execute(
+            sa.select(self.checkpoints.c.ItemId, self.checkpoints.c.CTag)
+            .where(self.checkpoints.c.Status == self.COMPLETE))}
+        pending = _resume_pending(committed, files)
+        if pending is not None:
+            logger.info('Resuming %s: %s of %s files already loaded',
+                        self.table.fullname, len(committed), len(files))
+            return pending
+
+        _prepare_shadow(connection, self.table, self.shadow)
+        trans = connection.begin()
+        connection.execute(self.checkpoints.delete())
+        trans.commit()
+        return list(files)
+
+    def load_file(self, connection, file, rows):
+        # Write one file's rows and its checkpoint, or neither
+        start = time.perf_counter()
+        loader = BulkLoader(connection, self.shadow, **self.loader_options)
+        trans = connection.begin()
+        try:
+            total = loader.write(rows)
+            self._record(connection, file, self.COMPLETE, total)
+            trans.commit()
+        except Exception:
+            trans.rollback()
+            raise
+
+        result = LoadResult(self.shadow.fullname, loader.strategy, total, time.perf_counter() - start)
+        logger.info('%s (%s)', result, file.get('FileName', file['id']))
+        return result
+
+    def record_failure(self, connection, file):
+        try:
+            trans = connection.begin()
+            self._record(connection, file, self.FAILED, 0)
+            trans.commit()
+        except Exception:  # pylint: disable=broad-except
+            # The failure that got us here matters more than this one
+            logger.exception('Could not record the failed checkpoint of %s', file['id'])
+
+    def finish(self, connection):
+        _reset_row_hashes(connection, self.table)
+        _switch_tables(connection, self.table, self.shadow, [self.checkpoints.delete()])
+
+    def _record(self, connection, file, status, rows):
+        connection.execute(self.checkpoints.delete().where(self.checkpoints.c.ItemId == file['id']))
+        connection.execute(self.checkpoints.insert().values(
+            ItemId=file['id'], CTag=file.get('cTag'), FileName=file.get('FileName'),
+            RowsWritten=rows, Status=status, Updated=datetime.now()))
+
+def _resume_pending(committed, files):
+    # The files still to load if a run that committed {item id: cTag}
+    # can be resumed: it committed something, and every file it
+    # committed is in files with the same, known cTag. Otherwise None.
+    tags = {file['id']: file.get('cTag') for file in files}
+    if committed and all(ctag is not None and tags.get(item_id) == ctag
+                         for item_id, ctag in committed.items()):
+        return [file for file in files if file['id'] not in committed]
+    return None
+
+def _checkpoint_table(table):
+    return sa.Table(table.name + CHECKPOINT_SUFFIX, sa.MetaData(),
+                    sa.Column('ItemId', sa.String(255), primary_key=True),
+                    sa.Column('CTag', sa.String(255)),
+                    sa.Column('FileName', sa.String(400)),
+                    sa.Column('RowsWritten', sa.Integer),
+                    sa.Column('Status', sa.String(16)),
+                    sa.Column('Updated', sa.DateTime),
+                    schema=table.schema)
+
+def _reset_checkpoints(connection, table):
+    preparer = connection.dialect.identifier_preparer
+    checkpoints = _checkpoint_table(table)
+    trans = connection.begin()
+    connection.execute(sa.text(
+        f"IF OBJECT_ID(:checkpoints, N'U') IS NOT NULL DELETE FROM {preparer.format_table(checkpoints)}"),
+        {'checkpoints': checkpoints.fullname})
+    trans.commit()
+
+def _merge_table_rows(connection, table, rows, loader_options):
+    # Compare each row's content hash with the one stored for its primary
+    # key, write only new, changed and missing keys to a delta table, and
+    # apply the delta with set-based statements in one transaction
+    key_positions = [index for index, column in enumerate(table.columns) if column.primary_key]
+    if not key_positions:
+        raise ValueError(f'{table.fullname} has no primary key to merge on')
+
+    start = time.perf_counter()
+    hashes = _row_hash_table(connection, table)
+    stored = _read_row_hashes(connection, hashes, len(key_positions))
+    if not stored:
+        # Nothing to compare against yet: reload in full and record hashes
+        return _baseline_load(connection, table, rows, hashes, key_positions, loader_options)
+
+    changes = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+    duplicates = []
+
+    delta = _prepare_delta(connection, table)
+    rows = iter(rows)
+    written = BulkLoader(connection, delta, **loader_options).load(
+        _delta_rows(table, rows, stored, key_positions, changes, duplicates))
+    if duplicates:
+        # The primary key is only nominal in the exports; reload in full,
+        # which keeps every row, from what the merge took in plus the rest
+        logger.warning('%s: key %s appears more than once; reloading in full instead of merging',
+                       table.fullname, tuple(duplicates[0][position] for position in key_positions))
+        rows = itertools.chain(_rows_before_duplicate(connection, table, delta, stored, key_positions),
+                               duplicates, rows)
+        return _baseline_load(connection, table, rows, hashes, key_positions, loader_options)
+
+    _apply_delta(connection, table, hashes, delta, key_positions)
+
+    result = LoadResult(table.fullname, f'merge/{written.strategy}', written.rows,
+                        time.perf_counter() - start, changes)
+    logger.info('%s %s', result, changes)
+    return result
+
+def _delta_rows(table, rows, stored, key_positions, changes, duplicates):
+    # Yield the delta rows for a merge: each new or changed row with its
+    # hash and 'U', then a key-only 'D' row for every stored key the rows
+    # did not contain. stored ({key: hash}) is consumed and changes is
+    # counted as rows go by. A row whose key was already seen is appended
+    # to duplicates and ends the delta there, with no 'D' rows, leaving
+    # the rest of rows unread.
+    seen = set()
+    for row in rows:
+        key = tuple(row[position] for position in key_positions)
+        if key in seen:
+            duplicates.append(row)
+            return
+        seen.add(key)
+
+        row_hash = _row_hash(row)
+        stored_hash = stored.pop(key, None)
+        if stored_hash == row_hash:
+            changes['unchanged'] += 1
+            continue
+        changes['updated' if stored_hash is not None else 'inserted'] += 1
+        yield tuple(row) + (row_hash, 'U')
+
+    # Keys left over were not in this export
+    for key in stored:
+        changes['deleted'] += 1
+        values = [None] * len(table.columns)
+        for position, value in zip(key_positions, key):
+            values[position] = value
+        yield tuple(values) + (None, 'D')
+
+def _rows_before_duplicate(connection, table, delta, stored, key_positions):
+    # The rows a merge took in before it stopped at a duplicate key: the
+    # new and changed ones it wrote to delta, and the unchanged ones, which
+    # are the live rows whose keys it consumed from stored. Read on a
+    # connection of their own while the reload writes on connection.
+    with connection.engine.connect() as reader:
+        written = set()
+        columns = [delta.c[column.name] for column in table.columns]
+        for row in reader.execute(sa.select(*columns).where(delta.c.ChangeType == 'U')):
+            written.add(tuple(row[position] for position in key_positions))
+            yield tuple(row)
+
+        for row in reader.execute(sa.select(table)):
+            key = tuple(row[position] for position in key_positions)
+            if key not in stored and key not in written:
+                yield tuple(row)
+
+def _baseline_load(connection, table, rows, hashes, key_positions, loader_options):
+    row_hashes = {}
+    duplicates = 0
+
+    def hashed(rows):
+        nonlocal duplicates
+        for row in rows:
+            key = tuple(row[position] for position in key_positions)
+            if key in row_hashes:
+                duplicates += 1
+            row_hashes[key] = _row_hash(row)
+            yield row
+
+    result = replace_table_rows(connection, table, hashed(rows), 'swap', **loader_options)
+    if duplicates:
+        logger.warning('%s has %s duplicate keys; merge loads will keep reloading it in full',
+                       table.fullname, duplicates)
+        return result
+
+    BulkLoader(connection, hashes, **loader_options).load(
+        key + (row_hash,) for key, row_hash in row_hashes.items())
+    result.changes = {'inserted': result.rows, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+    return result
+
+def _row_hash(row):
+    # repr is stable across processes, unlike hash()
+    return hashlib.sha256(repr(tuple(row)).encode('utf8')).digest()
+
+def _key_columns(table):
+    return [column for column in table.columns if column.primary_key]
+
+def _row_hash_table(connection, table):
+    # Primary key columns plus RowHash, created on first use
+    hashes = sa.Table(table.name + ROW_HASH_SUFFIX, sa.MetaData(),
+                      *[sa.Column(column.name, column.type) for column in _key_columns(table)],
+                      sa.Column('RowHash', sa.LargeBinary),
+                      schema=table.schema)
+
+    preparer = connection.dialect.identifier_preparer
+    keys = ', '.join(preparer.quote(column.name) for column in _key_columns(table))
+    trans = connection.begin()
+    connection.execute(sa.text(
+        f"IF OBJECT_ID(:hashes, N'U') IS NULL "
+        f"SELECT {keys}, CAST(NULL AS BINARY(32)) AS [RowHash] INTO {preparer.format_table(hashes)} "
+        f"FROM {preparer.format_table(table)} WHERE 1 = 0"),
+        {'hashes': hashes.fullname})
+    trans.commit()
+    return hashes
+
+def _read_row_hashes(connection, hashes, key_width):
+    preparer = connection.dialect.identifier_preparer
+    result = connection.execute(f'SELECT * FROM {preparer.format_table(hashes)}')
+    return {tuple(row[:key_width]): bytes(row[key_width]) for row in result}
+
+def _reset_row_hashes(connection, table):
+    preparer = connection.dialect.identifier_preparer
+    hashes = sa.Table(table.name + ROW_HASH_SUFFIX, sa.MetaData(), schema=table.schema)
+    trans = connection.begin()
+    connection.execute(sa.text(
+        f"IF OBJECT_ID(:hashes, N'U') IS NOT NULL TRUNCATE TABLE {preparer.format_table(hashes)}"),
+        {'hashes': hashes.fullname})
+    trans.commit()
+
+def _prepare_delta(connection, table):
+    # The live table's columns plus the new RowHash and a ChangeType of
+    # 'U' (insert or update) or 'D' (delete)
+    delta = table.to_metadata(sa.MetaData(), name=table.name + DELTA_SUFFIX)
+    delta.append_column(sa.Column('RowHash', sa.LargeBinary))
+    delta.append_column(sa.Column('ChangeType', sa.String(1)))
+
+    preparer = connection.dialect.identifier_preparer
+    trans = connection.begin()
+    connection.execute(sa.text(
+        f"IF OBJECT_ID(:delta, N'U') IS NULL "
+        f"SELECT *, CAST(NULL AS BINARY(32)) AS [RowHash], CAST(NULL AS CHAR(1)) AS [ChangeType] "
+        f"INTO {preparer.format_table(delta)} FROM {preparer.format_table(table)} WHERE 1 = 0 "
+        f"ELSE TRUNCATE TABLE {preparer.format_table(delta)}"),
+        {'delta': delta.fullname})
+    trans.commit()
+    return delta
+
+def _apply_delta(connection, table, hashes, delta, key_positions):
+    preparer = connection.dialect.identifier_preparer
+    live_name = preparer.format_table(table)
+    hashes_name = preparer.format_table(hashes)
+    delta_name = preparer.format_table(delta)
+
+    columns = [preparer.quote(column.name) for column in table.columns]
+    keys = [columns[position] for position in key_positions]
+    values = [column for position, column in enumerate(columns) if position not in key_positions]
+    on_keys = ' AND '.join(f'target.{key} = source.{key}' for key in keys)
+
+    upsert = (
+        f"MERGE {live_name} WITH (HOLDLOCK) AS target "
+        f"USING (SELECT {', '.join(columns)} FROM {delta_name} WHERE [ChangeType] = 'U') AS source "
+        f"ON {on_keys} "
+        f"WHEN MATCHED THEN UPDATE SET {', '.join(f'target.{column} = source.{column}' for column in values)} "
+        f"WHEN NOT MATCHED BY TARGET THEN INSERT ({', '.join(columns)}) "
+        f"VALUES ({', '.join(f'source.{column}' for column in columns)});")
+    delete = (
+        f"DELETE target FROM {live_name} AS target JOIN {delta_name} AS source "
+        f"ON {on_keys} WHERE source.[ChangeType] = 'D';")
+    record_hashes = (
+        f"MERGE {hashes_name} AS target USING {delta_name} AS source ON {on_keys} "
+        f"WHEN MATCHED AND source.[ChangeType] = 'D' THEN DELETE "
+        f"WHEN MATCHED THEN UPDATE SET target.[RowHash] = source.[RowHash] "
+        f"WHEN NOT MATCHED BY TARGET AND source.[ChangeType] = 'U' THEN INSERT ({', '.join(keys)}, [RowHash]) "
+        f"VALUES ({', '.join(f'source.{key}' for key in keys)}, source.[RowHash]);")
+
+    trans = connection.begin()
+    try:
+        for statement in (upsert, delete, record_hashes):
+            connection.execute(statement)
+        trans.commit()
+    except Exception:
+        trans.rollback()
+        raise
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _write_executemany(loader, chunk):
+    if loader.connection.dialect.name == 'mssql':
+        # Go to the pyodbc cursor so fast_executemany sends the chunk as
+        # one parameter array instead of a round trip per row
+        cursor = loader.connection.connection.cursor()
+        try:
+            cursor.fast_executemany = True
+            cursor.executemany(_insert_sql(loader), [tuple(row) for row in chunk])
+        finally:
+            cursor.close()
+        return
+
+    loader.connection.execute(loader.table.insert(), loader._as_dicts(chunk))
+
+def _write_values(loader, chunk):
+    rows_per_statement = max(1, min(MAX_VALUES_ROWS, (MAX_PARAMETERS - 1) // len(loader.column_keys)))
+
+    if loader.connection.dialect.paramstyle != 'qmark':
+        for start in range(0, len(chunk), rows_per_statement):
+            loader.connection.execute(
+                loader.table.insert().values(loader._as_dicts(chunk[start:start + rows_per_statement])))
+        return
+
+    # Build the statement text once per row count rather than having
+    # SQLAlchemy compile a new multi-row INSERT for every statement
+    cursor = loader.connection.connection.cursor()
+    try:
+        for start in range(0, len(chunk), rows_per_statement):
+            rows = chunk[start:start + rows_per_statement]
+            cursor.execute(_insert_sql(loader, len(rows)), [value for row in rows for value in row])
+    finally:
+        cursor.close()
+
+def _write_tvp(loader, chunk):
+    if loader.connection.dialect.name != 'mssql':
+        raise ValueError('The tvp bulk load strategy needs SQL Server')
+
+    preparer = loader.connection.dialect.identifier_preparer
+    schema = loader.table.schema or 'dbo'
+    # pyodbc takes the table type name and schema as the first two items
+    tvp = [f'{loader.table.name}Type', schema] + [tuple(row) for row in chunk]
+
+    cursor = loader.connection.connection.cursor()
+    try:
+        cursor.execute(f'INSERT INTO {preparer.format_table(loader.table)} SELECT * FROM ?', [tvp])
+    finally:
+        cursor.close()
+
+def _insert_sql(loader, row_count=1):
+    preparer = loader.connection.dialect.identifier_preparer
+    columns = ', '.join(preparer.quote(column.name) for column in loader.table.columns)
+    placeholders = '(' + ', '.join('?' for _ in loader.table.columns) + ')'
+    values = ', '.join([placeholders] * row_count)
+    return f'INSERT INTO {preparer.format_table(loader.table)} ({columns}) VALUES {values}'
+
+STRATEGIES = {
+    'executemany': _write_executemany,
+    'values': _write_values,
+    'tvp': _write_tvp,
+}
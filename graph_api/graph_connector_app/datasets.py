@@ -0,0 +1,113 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from dateutil import parser
+from graph_connector_app.graph_helper import get_filelist, resolve_worksheet_names
+from graph_connector_app.ingest_pipeline import run_ingest_pipeline
+from graph_connector_app.sqlalchemy_models import sql_models as sm
+
+logger = logging.getLogger(__name__)
+
+class Dataset:
+    """A staging table fed from the district workbooks whose names match it
+
+    prefix(file) gives the leading table columns that do not come from the
+    worksheet, and drop_rules maps drop reasons to row predicates on top of
+    the pipeline's own header and blank key rules.
+    """
+
+    def __init__(self, name, model, name_fragment, prefix, drop_rules=None):
+        self.name = name
+        self.model = model
+        self.name_fragment = name_fragment
+        self.prefix = prefix
+        self.drop_rules = drop_rules or {}
+
+    @property
+    def table(self):
+        return self.model.__table__
+
+    def matches(self, file_name):
+        return self.name_fragment in file_name.lower()
+
+DATASETS = {}
+
+def register_dataset(dataset):
+    DATASETS[dataset.name] = dataset
+    return dataset
+
+def _blank_column(model, name):
+    # Drop rule for rows where the named column is blank, located by the
+    # column's position in the model's table
+    index = list(model.__table__.columns).index(model.__table__.columns[name])
+    return lambda record: record[index] in ('', None)
+
+register_dataset(Dataset(
+    'math_iready', sm.MathiReady, '_math',
+    lambda file: [file['ParentDirectory'], 'Math iReady']))
+register_dataset(Dataset(
+    'reading_iready', sm.ReadingiReady, '_ela',
+    lambda file: [file['ParentDirectory'], 'ELA iReady']))
+register_dataset(Dataset(
+    'eligibility', sm.Eligibility, 'eligibility',
+    lambda file: [file['ParentDirectory'], 'Eligibility', file['AcademicYear']],
+    {'blank_LastName': _blank_column(sm.Eligibility, 'LastName')}))
+
+def route_files(token, drive, directory, datasets):
+    # List the directory once and return {dataset name: file_info_list}
+    # for the files each dataset matches
+    routed = {dataset.name: [] for dataset in datasets}
+    for file in get_filelist(token,drive,directory):
+        file_dict = {}
+        file_dict['FileName'] = file['name']
+        file_dict['id'] = file['id']
+        created_date = parser.parse(file['createdDateTime'])
+        file_dict['createdDateTime'] = created_date.strftime('%Y-%m-%d %H:%M:%S')
+        file_dict['ParentDirectory'] = file['parentReference']['path'].rsplit('/', 1)[-1]
+        file_dict['AcademicYear'] = file['parentReference']['path'].rsplit('/', 2)[-2][:9]
+        file_dict['cTag'] = file.get('cTag', file.get('eTag'))
+
+        for dataset in datasets:
+            if dataset.matches(file_dict['FileName']):
+                routed[dataset.name].append(dict(file_dict))
+    return routed
+
+def ingest_datasets(token_source, drive, directory, names=None, progress=None):
+    # One pass over directory for the named datasets (all by default):
+    # list once, resolve the worksheet names of matching files in one
+    # batch, then load every dataset's staging table concurrently.
+    # token_source is called for an app token whenever one is needed.
+    # Without names, datasets with no matching files are left untouched
+    # rather than emptied. progress, if given, is called with
+    # {dataset name: counts dict}. Returns {dataset name: counts dict}.
+    datasets = [DATASETS[name] for name in (names or DATASETS)]
+    routed = route_files(token_source(), drive, directory, datasets)
+    if not names:
+        datasets = [dataset for dataset in datasets if routed[dataset.name]]
+    resolve_worksheet_names(token_source(),drive,[file for files in routed.values() for file in files])
+
+    running = {}
+    running_lock = threading.Lock()
+
+    def report(name, counts):
+        with running_lock:
+            running[name] = counts.as_dict()
+            snapshot = dict(running)
+        if progress is not None:
+            progress(snapshot)
+
+    def load(dataset):
+        with sm.db.connect() as connection:
+            counts = run_ingest_pipeline(token_source,drive,routed[dataset.name],connection,
+                                         dataset.table,dataset.prefix,dataset.drop_rules,
+                                         progress=lambda counts: report(dataset.name, counts))
+        report(dataset.name, counts)
+        return counts.as_dict()
+
+    with ThreadPoolExecutor(max_workers=len(datasets) or 1) as executor:
+        futures = {dataset.name: executor.submit(load, dataset) for dataset in datasets}
+        return {name: future.result() for name, future in futures.items()}
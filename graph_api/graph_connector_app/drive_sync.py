@@ -0,0 +1,219 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from graph_connector_app.graph_helper import GRAPH_URL, get_filelist, graph_request
+from graph_connector_app.listing_cache import get_listing_cache
+
+logger = logging.getLogger(__name__)
+
+# Location of the local drive mirror and how often it is refreshed.
+# Override with the DRIVE_MIRROR_PATH and DRIVE_SYNC_INTERVAL (seconds)
+# environment variables.
+DRIVE_MIRROR_PATH = os.environ.get('DRIVE_MIRROR_PATH', 'drive_mirror.sqlite3')
+DRIVE_SYNC_INTERVAL = int(os.environ.get('DRIVE_SYNC_INTERVAL', '60'))
+
+class DriveMirror:
+    """Local copy of a drive's folder tree kept current with the Graph delta API
+
+    A daemon thread applies the drive's changes every sync_interval
+    seconds, so listing a folder only reads the mirror. Until the first
+    sync has finished, folders are listed from Graph directly.
+    token_source is called for an app token before each sync.
+    """
+
+    def __init__(self, drive, token_source, path=DRIVE_MIRROR_PATH, sync_interval=DRIVE_SYNC_INTERVAL):
+        self.drive = drive.rstrip('/')
+        self.path = path
+        self.sync_interval = sync_interval
+        self.token_source = token_source
+        self._synced = False
+        # _sync_lock is held while a sync waits on Graph; request paths only
+        # ever take _start_lock, so a slow sync never blocks a listing
+        self._sync_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        # directory -> serialized children, cleared whenever a sync changes anything
+        self._children = {}
+
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS drive_items (
+                    drive TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    parent_id TEXT,
+                    name TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (drive, id)
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_drive_items_parent ON drive_items (drive, parent_id)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS drive_sync_state (
+                    drive TEXT PRIMARY KEY,
+                    delta_link TEXT
+                )""")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def start(self):
+        # Start the background sync thread if it is not running
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='drive-sync', daemon=True)
+                self._thread.start()
+
+    def sync_soon(self):
+        # Ask the sync thread to apply pending changes now
+        self.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh(self.token_source())
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Drive mirror sync failed for %s', self.drive)
+            self._wake.wait(self.sync_interval)
+            self._wake.clear()
+
+    def refresh(self, token):
+        # Apply outstanding changes from Graph and return how many changed
+        # items were applied. Listings cached from the mirror are dropped
+        # when anything changed.
+        with self._sync_lock:
+            changes = self._apply_delta(token)
+            if changes:
+                self._children = {}
+        if changes:
+            get_listing_cache().invalidate()
+        self._synced = True
+        return changes
+
+    def has_synced(self):
+        # A mirror file from an earlier process counts once it has a delta link
+        if not self._synced:
+            with self._connect() as conn:
+                row = conn.execute("SELECT delta_link FROM drive_sync_state WHERE drive = ?",
+                    (self.drive,)).fetchone()
+            self._synced = bool(row and row[0])
+        return self._synced
+
+    def _apply_delta(self, token):
+        full_sync_url = f'{GRAPH_URL}{self.drive}/root/delta'
+        changes = 0
+
+        with self._connect() as conn:
+            row = conn.execute("SELECT delta_link FROM drive_sync_state WHERE drive = ?",
+                (self.drive,)).fetchone()
+            url = row[0] if row and row[0] else full_sync_url
+            delta_link = None
+
+            while url:
+                response = graph_request('GET', url, token, 'delta')
+                if response.status_code == 410:
+                    # The delta token has expired; rebuild from a full enumeration
+                    conn.execute("DELETE FROM drive_items WHERE drive = ?", (self.drive,))
+                    url = full_sync_url
+                    continue
+                response.raise_for_status()
+                page = response.json()
+
+                for item in page.get('value', []):
+                    self._apply_item(conn, item)
+                    changes += 1
+
+                url = page.get('@odata.nextLink')
+                delta_link = page.get('@odata.deltaLink', delta_link)
+
+            conn.execute("INSERT OR REPLACE INTO drive_sync_state (drive, delta_link) VALUES (?, ?)",
+                (self.drive, delta_link))
+
+        return changes
+
+    def _apply_item(self, conn, item):
+        if 'deleted' in item:
+            conn.execute("DELETE FROM drive_items WHERE drive = ? AND id = ?", (self.drive, item['id']))
+            return
+
+        # The drive root has no parent id
+        parent_id = None if 'root' in item else item.get('parentReference', {}).get('id')
+        conn.execute(
+            "INSERT OR REPLACE INTO drive_items (drive, id, parent_id, name, data) VALUES (?, ?, ?, ?, ?)",
+            (self.drive, item['id'], parent_id, item.get('name', ''), json.dumps(item)))
+
+    def list_children(self, directory):
+        # Return the children of a folder from the mirror, shaped like a
+        # Graph /children listing. directory uses the same form as
+        # get_filelist, e.g. 'root:/IT Solutions/2024-2025 Data:/children'
+        self.start()
+        if not self.has_synced():
+            return list(get_filelist(self.token_source(), self.drive + '/', directory))
+
+        # A sync that lands while this loads replaces the dict, so a stale
+        # listing is never stored in the new one
+        children = self._children
+        serialized = children.get(directory)
+        if serialized is None:
+            serialized = children[directory] = self._load_children(directory)
+
+        return [json.loads(item) for item in serialized]
+
+    def _load_children(self, directory):
+        segments = _directory_segments(directory)
+        parent_path = '/drive/root:' + ''.join(f'/{segment}' for segment in segments)
+
+        with self._connect() as conn:
+            row = conn.execute("SELECT id FROM drive_items WHERE drive = ? AND parent_id IS NULL",
+                (self.drive,)).fetchone()
+            for segment in segments:
+                if row is None:
+                    return []
+                row = conn.execute(
+                    "SELECT id FROM drive_items WHERE drive = ? AND parent_id = ? AND name = ? COLLATE NOCASE",
+                    (self.drive, row[0], segment)).fetchone()
+            if row is None:
+                return []
+
+            children = []
+            for (data,) in conn.execute(
+                    "SELECT data FROM drive_items WHERE drive = ? AND parent_id = ? ORDER BY name COLLATE NOCASE",
+                    (self.drive, row[0])):
+                item = json.loads(data)
+                # Delta responses omit the parent path, so rebuild it
+                item.setdefault('parentReference', {})['path'] = parent_path
+                children.append(json.dumps(item))
+
+        return children
+
+def _directory_segments(directory):
+    # 'root:/IT Solutions/2024-2025 Data:/children' -> ['IT Solutions', '2024-2025 Data']
+    path = directory.strip('/')
+    if path.startswith('root:'):
+        path = path[len('root:'):]
+    if path.endswith(':/children'):
+        path = path[:-len(':/children')]
+    return [segment for segment in path.split('/') if segment]
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+def get_drive_mirror(drive, token_source):
+    # Return the process-wide mirror for a drive, creating it on first use
+    with _mirrors_lock:
+        if drive not in _mirrors:
+            _mirrors[drive] = DriveMirror(drive, token_source)
+        return _mirrors[drive]
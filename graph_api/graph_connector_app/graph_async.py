@@ -0,0 +1,142 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import asyncio
+import weakref
+
+import httpx
+
+from graph_connector_app.graph_helper import (GRAPH_BACKOFF_BASE, GRAPH_BACKOFF_MAX,
+                                              GRAPH_MAX_RETRIES, GRAPH_POOL_SIZE, GRAPH_TIMEOUTS,
+                                              GRAPH_URL, graph_stats)
+from graph_connector_app.graph_throttle import (RETRY_STATUSES, AsyncAdaptiveLimiter, retry_delay,
+                                                retry_statuses)
+from graph_connector_app.worksheet_cache import get_worksheet_cache
+
+# An httpx client is tied to the event loop it was first used on, so each
+# loop gets its own, with its own AIMD limiter; the entry goes when the
+# loop is garbage collected
+_clients = weakref.WeakKeyDictionary()
+
+def _loop_state():
+    # (client, limiter) for the running event loop, created on first use
+    loop = asyncio.get_running_loop()
+    state = _clients.get(loop)
+    if state is None:
+        state = _clients[loop] = (
+            httpx.AsyncClient(limits=httpx.Limits(max_connections=GRAPH_POOL_SIZE,
+                                                  max_keepalive_connections=GRAPH_POOL_SIZE)),
+            AsyncAdaptiveLimiter(GRAPH_POOL_SIZE))
+    return state
+
+def get_async_client():
+    # Return the Graph client for the running event loop, creating it on
+    # first use. Like the requests session it keeps connections alive.
+    return _loop_state()[0]
+
+async def graph_request(method, url, token, endpoint='default', headers=None, **kwargs):
+    # The async counterpart of graph_helper.graph_request: same timeouts,
+    # retries, adaptive concurrency limit and counters, but waiting on
+    # Graph yields the event loop instead of holding a thread. kwargs are
+    # passed to httpx.
+    request_headers = {
+        'Authorization': f'Bearer {token}'
+    }
+    if headers:
+        request_headers.update(headers)
+
+    connect_timeout, read_timeout = GRAPH_TIMEOUTS.get(endpoint, GRAPH_TIMEOUTS['default'])
+    timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+
+    retryable = retry_statuses(method, url)
+    attempt = 0
+    client, limiter = _loop_state()
+    while True:
+        throttled = False
+        await limiter.acquire()
+        try:
+            response = await client.request(method, url,
+                headers=request_headers,
+                timeout=timeout,
+                **kwargs)
+            throttled = response.status_code in RETRY_STATUSES
+        finally:
+            limiter.release(throttled)
+        graph_stats.increment('requests')
+
+        if not throttled:
+            return response
+
+        graph_stats.increment('throttled')
+        if attempt >= GRAPH_MAX_RETRIES or response.status_code not in retryable:
+            return response
+
+        graph_stats.increment('retries')
+        await asyncio.sleep(retry_delay(response.headers.get('Retry-After'), attempt,
+            GRAPH_BACKOFF_BASE, GRAPH_BACKOFF_MAX))
+        attempt += 1
+
+async def get_calendar_events(token, start, end, timezone, page_size=50):
+    # Set headers
+    headers = {
+        'Prefer': f'outlook.timezone="{timezone}"'
+    }
+
+    # Configure query parameters to
+    # modify the results
+    query_params = {
+        'startDateTime': start,
+        'endDateTime': end,
+        '$select': 'subject,organizer,start,end',
+        '$orderby': 'start/dateTime',
+        '$top': str(page_size)
+    }
+
+    # Send GET to /me/events and yield every event across all pages
+    async for event in _iter_pages(token, f'{GRAPH_URL}/me/calendarview', 'calendar',
+            headers=headers,
+            params=query_params):
+        yield event
+
+async def _iter_pages(token, url, endpoint, headers=None, params=None):
+    # Follow @odata.nextLink, requesting the next page while the caller
+    # works through the current one
+    task = asyncio.ensure_future(_get_page(token, url, endpoint, headers, params))
+    try:
+        while task is not None:
+            page = await task
+            next_link = page.get('@odata.nextLink')
+            # The nextLink already carries the original query parameters
+            task = asyncio.ensure_future(_get_page(token, next_link, endpoint, headers, None)) if next_link else None
+            for item in page.get('value', []):
+                yield item
+    finally:
+        if task is not None:
+            task.cancel()
+
+async def _get_page(token, url, endpoint, headers, params):
+    page = await graph_request('GET', url, token, endpoint,
+        headers=headers,
+        params=params)
+    page.raise_for_status()
+    return page.json()
+
+async def get_file_data(token,drive,file_id,worksheet_name,tag=None):
+    # As graph_helper.get_file_data; the worksheet cache is SQLite on
+    # local disk, so it is read and written on a worker thread
+    cache = get_worksheet_cache()
+    values = await asyncio.to_thread(cache.get, file_id, tag, worksheet_name)
+    if values is not None:
+        return {'values': values}
+
+    worksheet_data = await graph_request('GET',
+        f'{GRAPH_URL}{drive}/items/{file_id}/workbook/worksheets/{worksheet_name}/usedRange/?$select=values',
+        token, 'file_data')
+
+    worksheet_data.raise_for_status()
+    worksheet_data = worksheet_data.json()
+    if 'values' in worksheet_data:
+        await asyncio.to_thread(cache.put, file_id, tag, worksheet_name, worksheet_data['values'])
+
+    # Return the first WORKSHEET result
+    return worksheet_data
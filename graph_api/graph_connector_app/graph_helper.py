@@ -2,28 +2,146 @@
 # Licensed under the MIT License.
 
 import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from graph_connector_app.graph_throttle import (RETRY_STATUSES, AdaptiveLimiter,
+                                                GraphStats, retry_delay, retry_statuses)
+from graph_connector_app.worksheet_cache import get_worksheet_cache
+from graph_connector_app.xlsx_reader import read_worksheet_values
 
 GRAPH_URL = 'https://graph.microsoft.com/v1.0'
 
+# Size of the shared connection pool used for Graph calls.
+# Override with the GRAPH_POOL_SIZE environment variable.
+GRAPH_POOL_SIZE = int(os.environ.get('GRAPH_POOL_SIZE', '10'))
+
+# (connect, read) timeouts in seconds for each Graph endpoint
+GRAPH_TIMEOUTS = {
+    'default': (5, 100),
+    'user': (5, 30),
+    'calendar': (5, 30),
+    'event': (5, 30),
+    'filelist': (5, 60),
+    'worksheets': (5, 60),
+    'file_data': (5, 300),
+    'batch': (5, 120),
+    'delta': (5, 120),
+    'content': (5, 300),
+}
+
+# Graph accepts at most 20 sub-requests per $batch call
+GRAPH_BATCH_LIMIT = 20
+
+# Maximum number of worksheet downloads in flight at once.
+# Override with the GRAPH_MAX_IN_FLIGHT environment variable.
+GRAPH_MAX_IN_FLIGHT = int(os.environ.get('GRAPH_MAX_IN_FLIGHT', '4'))
+
+# How ingestion reads worksheets: 'rest' uses the workbook usedRange API,
+# 'download' fetches the xlsx file and parses it locally.
+# Override with the GRAPH_INGEST_MODE environment variable.
+GRAPH_INGEST_MODE = os.environ.get('GRAPH_INGEST_MODE', 'rest')
+
+# Rows fetched per request by the windowed worksheet reader.
+# Override with the GRAPH_WINDOW_ROWS environment variable.
+GRAPH_WINDOW_ROWS = int(os.environ.get('GRAPH_WINDOW_ROWS', '5000'))
+
+# Worksheets read in windows are kept for the worksheet cache when they
+# have at most this many cells, about one window of a 50-column sheet.
+# The kept rows are buffered until the last window, and a cache hit
+# returns the whole sheet, so this bounds the memory either costs.
+# Override with GRAPH_CACHE_MAX_CELLS.
+GRAPH_CACHE_MAX_CELLS = int(os.environ.get('GRAPH_CACHE_MAX_CELLS', '250000'))
+
+# Retries for throttled (429) or unavailable (503/504) responses, with
+# backoff delays in seconds. Override with GRAPH_MAX_RETRIES.
+GRAPH_MAX_RETRIES = int(os.environ.get('GRAPH_MAX_RETRIES', '5'))
+GRAPH_BACKOFF_BASE = 1.0
+GRAPH_BACKOFF_MAX = 60.0
+
+_session = None
+_session_lock = threading.Lock()
+
+# Shared concurrency limit and counters for every Graph call
+_limiter = AdaptiveLimiter(GRAPH_POOL_SIZE)
+graph_stats = GraphStats()
+
+def get_session():
+    # Return the process-wide Graph session, creating it on first use.
+    # The session keeps connections alive so repeated calls skip the
+    # TCP and TLS handshake.
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session(GRAPH_POOL_SIZE)
+    return _session
+
+def _build_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def graph_request(method, url, token, endpoint='default', headers=None, **kwargs):
+    # Send a request through the shared session using the timeout
+    # configured for the endpoint. Throttled and unavailable responses
+    # are retried up to GRAPH_MAX_RETRIES times (non-idempotent requests
+    # only when throttled, see retry_statuses); the last response is
+    # returned whatever its status.
+    request_headers = {
+        'Authorization': f'Bearer {token}'
+    }
+    if headers:
+        request_headers.update(headers)
+
+    retryable = retry_statuses(method, url)
+    attempt = 0
+    while True:
+        throttled = False
+        _limiter.acquire()
+        try:
+            response = get_session().request(method, url,
+                headers=request_headers,
+                timeout=GRAPH_TIMEOUTS.get(endpoint, GRAPH_TIMEOUTS['default']),
+                **kwargs)
+            throttled = response.status_code in RETRY_STATUSES
+        finally:
+            _limiter.release(throttled)
+        graph_stats.increment('requests')
+
+        if not throttled:
+            return response
+
+        graph_stats.increment('throttled')
+        if attempt >= GRAPH_MAX_RETRIES or response.status_code not in retryable:
+            return response
+
+        graph_stats.increment('retries')
+        time.sleep(retry_delay(response.headers.get('Retry-After'), attempt,
+            GRAPH_BACKOFF_BASE, GRAPH_BACKOFF_MAX))
+        attempt += 1
+
 def get_user(token):
     # Send GET to /me
-    user = requests.get(
-        f'{GRAPH_URL}/me',
-        headers={
-          'Authorization': f'Bearer {token}'
-        },
+    user = graph_request('GET', f'{GRAPH_URL}/me', token, 'user',
         params={
           '$select': 'displayName,mail,mailboxSettings,userPrincipalName'
-        },
-        timeout = 100)
+        })
+    user.raise_for_status()
     # Return the JSON result
     return user.json()
 
-def get_calendar_events(token, start, end, timezone):
+def get_calendar_events(token, start, end, timezone, page_size=50):
     # Set headers
     headers = {
-        'Authorization': f'Bearer {token}',
         'Prefer': f'outlook.timezone="{timezone}"'
     }
 
@@ -34,60 +152,59 @@ def get_calendar_events(token, start, end, timezone):
         'endDateTime': end,
         '$select': 'subject,organizer,start,end',
         '$orderby': 'start/dateTime',
-        '$top': '50'
+        '$top': str(page_size)
     }
 
-    # Send GET to /me/events
-    events = requests.get(f'{GRAPH_URL}/me/calendarview',
+    # Send GET to /me/events and yield every event across all pages
+    yield from _iter_pages(token, f'{GRAPH_URL}/me/calendarview', 'calendar',
         headers=headers,
-        params=query_params,
-        timeout = 100)
-
-    # Return the JSON result
-    return events.json()
-
-def get_filelist(token,drive,directory):
-    # Set headers
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
+        params=query_params)
 
+def get_filelist(token,drive,directory,page_size=None):
     # Configure query parameters to
     # modify the results
     query_params = {
 
     }
-
-    url = f'{GRAPH_URL}{drive}{directory}'
-
-
-    files = requests.get(f'{GRAPH_URL}{drive}{directory}',
+    if page_size:
+        query_params['$top'] = str(page_size)
+
+    # Yield every item in the folder across all pages
+    yield from _iter_pages(token, f'{GRAPH_URL}{drive}{directory}', 'filelist',
+        params=query_params)
+
+def _iter_pages(token, url, endpoint, headers=None, params=None):
+    # Follow @odata.nextLink, yielding items as each page arrives.
+    # The next page is requested in the background while the caller
+    # works through the current one.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(_get_page, token, url, endpoint, headers, params)
+        while future is not None:
+            page = future.result()
+            next_link = page.get('@odata.nextLink')
+            # The nextLink already carries the original query parameters
+            future = executor.submit(_get_page, token, next_link, endpoint, headers, None) if next_link else None
+            yield from page.get('value', [])
+
+def _get_page(token, url, endpoint, headers, params):
+    page = graph_request('GET', url, token, endpoint,
         headers=headers,
-        params=query_params,
-        timeout = 100
-        )
-
-    # Return the JSON result
-    return files.json()
+        params=params)
+    page.raise_for_status()
+    return page.json()
 
 def get_worksheets(token,drive,file_id):
-    # Set headers
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
-
     # Configure query parameters to
     # modify the results
     query_params = {
 
     }
 
-    worksheets = requests.get(f'{GRAPH_URL}{drive}/items/{file_id}/workbook/worksheets',
-        headers=headers,
-        params=query_params,
-        timeout = 100
-        )
+    worksheets = graph_request('GET', f'{GRAPH_URL}{drive}/items/{file_id}/workbook/worksheets',
+        token, 'worksheets',
+        params=query_params)
 
+    worksheets.raise_for_status()
     worksheets = worksheets.json()
 
     worksheet_data = {}
@@ -98,11 +215,155 @@ def get_worksheets(token,drive,file_id):
     # Return the first WORKSHEET result
     return worksheet_data
 
-def get_file_data(token,drive,file_id,worksheet_name):
-    # Set headers
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
+def send_batch(token, batch_items):
+    # Send sub-requests through the Graph JSON $batch endpoint
+    # https://learn.microsoft.com/graph/json-batching
+    # Each item is a dict with 'id', 'method' and 'url' (relative to GRAPH_URL)
+    # and optionally 'dependsOn', 'headers' and 'body'.
+    # Returns a dict of id -> {'status', 'headers', 'body'}. Failed
+    # sub-requests are returned with their status rather than raised.
+    # Throttled sub-requests, and the ones that failed because they
+    # depend on them, are resent up to GRAPH_MAX_RETRIES times.
+    responses = {}
+    pending = list(batch_items)
+    attempt = 0
+
+    while pending:
+        retry_after = None
+        for chunk in _chunk_batch_items(pending):
+            result = graph_request('POST', f'{GRAPH_URL}/$batch', token, 'batch',
+                headers={'Content-Type': 'application/json'},
+                data=json.dumps({'requests': chunk}))
+            result.raise_for_status()
+
+            for response in result.json().get('responses', []):
+                responses[response['id']] = {
+                    'status': response.get('status'),
+                    'headers': response.get('headers', {}),
+                    'body': response.get('body')
+                }
+                if response.get('status') in RETRY_STATUSES:
+                    graph_stats.increment('throttled')
+                    retry_after = retry_after or response.get('headers', {}).get('Retry-After')
+
+            # Mark any sub-request Graph did not answer as failed
+            for item in chunk:
+                if item['id'] not in responses:
+                    responses[item['id']] = {'status': None, 'headers': {}, 'body': None}
+
+        throttled = {item['id'] for item in pending if responses[item['id']]['status'] in RETRY_STATUSES}
+        if not throttled or attempt >= GRAPH_MAX_RETRIES:
+            break
+
+        pending = [item for item in pending
+                   if item['id'] in throttled
+                   or (responses[item['id']]['status'] == 424
+                       and any(dependency in throttled for dependency in item.get('dependsOn', [])))]
+        # Keep only dependencies that are being resent
+        resent = {item['id'] for item in pending}
+        for index, item in enumerate(pending):
+            if item.get('dependsOn'):
+                item = {key: value for key, value in item.items() if key != 'dependsOn'}
+                depends_on = [dependency for dependency in pending[index]['dependsOn'] if dependency in resent]
+                if depends_on:
+                    item['dependsOn'] = depends_on
+                pending[index] = item
+
+        graph_stats.increment('retries')
+        time.sleep(retry_delay(retry_after, attempt, GRAPH_BACKOFF_BASE, GRAPH_BACKOFF_MAX))
+        attempt += 1
+
+    return responses
+
+def _chunk_batch_items(batch_items):
+    # Split items into chunks of at most GRAPH_BATCH_LIMIT, keeping every
+    # dependsOn chain inside a single chunk as Graph requires
+    groups = {}
+    group_of = {}
+    for item in batch_items:
+        depends_on = item.get('dependsOn', [])
+        if not depends_on:
+            group_of[item['id']] = item['id']
+            groups[item['id']] = [item]
+            continue
+
+        for dependency in depends_on:
+            if dependency not in group_of:
+                raise ValueError(f"Batch item {item['id']} depends on unknown or later item {dependency}")
+
+        # Merge all dependency groups into the first one
+        target = group_of[depends_on[0]]
+        for dependency in depends_on[1:]:
+            source = group_of[dependency]
+            if source != target:
+                for moved in groups.pop(source):
+                    group_of[moved['id']] = target
+                    groups[target].append(moved)
+        group_of[item['id']] = target
+        groups[target].append(item)
+
+    chunk = []
+    for group in groups.values():
+        if len(group) > GRAPH_BATCH_LIMIT:
+            raise ValueError(f'A dependsOn chain of {len(group)} items exceeds the batch limit of {GRAPH_BATCH_LIMIT}')
+        if len(chunk) + len(group) > GRAPH_BATCH_LIMIT:
+            yield chunk
+            chunk = []
+        chunk.extend(group)
+
+    if chunk:
+        yield chunk
+
+def get_worksheets_batch(token,drive,file_ids):
+    # Resolve the first worksheet of many files using $batch
+    # Returns a dict of file_id -> worksheet_data like get_worksheets
+    batch_items = []
+    for index, file_id in enumerate(file_ids):
+        batch_items.append({
+            'id': str(index),
+            'method': 'GET',
+            'url': f"{drive.rstrip('/')}/items/{file_id}/workbook/worksheets?$select=id,name"
+        })
+
+    responses = send_batch(token, batch_items)
+
+    worksheets = {}
+    for index, file_id in enumerate(file_ids):
+        response = responses[str(index)]
+        if response['status'] == 200 and response['body'] and response['body'].get('value'):
+            first_sheet = response['body']['value'][0]
+            worksheets[file_id] = {
+                'WorksheetID': first_sheet['id'],
+                'WorksheetName': first_sheet['name']
+            }
+        else:
+            # Fall back to a single request for items that failed in the batch
+            worksheets[file_id] = get_worksheets(token,drive,file_id)
+
+    return worksheets
+
+def resolve_worksheet_names(token,drive,file_info_list):
+    # Set 'WorksheetName' on each entry of file_info_list, taking it from
+    # the worksheet cache when the file's cTag is unchanged and resolving
+    # the rest with a single $batch pass
+    cache = get_worksheet_cache()
+    unresolved = []
+    for file in file_info_list:
+        file['WorksheetName'] = cache.get_worksheet_name(file['id'], file.get('cTag'))
+        if file['WorksheetName'] is None:
+            unresolved.append(file)
+
+    worksheets = get_worksheets_batch(token,drive,[file['id'] for file in unresolved])
+    for file in unresolved:
+        file['WorksheetName'] = worksheets[file['id']]['WorksheetName']
+
+def get_file_data(token,drive,file_id,worksheet_name,tag=None):
+    # Serve unchanged workbooks from the worksheet cache
+    # tag is the drive item's cTag (or eTag); without one nothing is cached
+    cache = get_worksheet_cache()
+    values = cache.get(file_id, tag, worksheet_name)
+    if values is not None:
+        return {'values': values}
 
     # Configure query parameters to
     # modify the results
@@ -110,15 +371,93 @@ def get_file_data(token,drive,file_id,worksheet_name):
 
     }
 
-    worksheet_data = requests.get(f'{GRAPH_URL}{drive}/items/{file_id}/workbook/worksheets/{worksheet_name}/usedRange/?$select=values',
-        headers=headers,
-        params=query_params,
-        timeout = 100
-        )
+    worksheet_data = graph_request('GET',
+        f'{GRAPH_URL}{drive}/items/{file_id}/workbook/worksheets/{worksheet_name}/usedRange/?$select=values',
+        token, 'file_data',
+        params=query_params)
+
+    worksheet_data.raise_for_status()
+    worksheet_data = worksheet_data.json()
+    if 'values' in worksheet_data:
+        cache.put(file_id, tag, worksheet_name, worksheet_data['values'])
 
     # Return the first WORKSHEET result
-    return worksheet_data.json()
+    return worksheet_data
 
+def iter_file_data_windows(token_source,drive,file_id,worksheet_name,tag=None,window_rows=None):
+    # Yield the usedRange of a worksheet as lists of at most window_rows
+    # rows, so large sheets never have to be buffered in one response.
+    # token_source is called for a token before each request, as reading
+    # a large sheet can take longer than a token lasts.
+    # Cached values are served from the worksheet cache. With a tag,
+    # sheets of up to GRAPH_CACHE_MAX_CELLS cells are also kept as they
+    # are read and cached once the last window has been consumed.
+    window_rows = window_rows or GRAPH_WINDOW_ROWS
+
+    values = get_worksheet_cache().get(file_id, tag, worksheet_name)
+    if values is not None:
+        for start in range(0, len(values), window_rows):
+            yield values[start:start + window_rows]
+        return
+
+    worksheet_url = f'{GRAPH_URL}{drive}/items/{file_id}/workbook/worksheets/{worksheet_name}'
+
+    # Ask only for the address of the used range, e.g. Sheet1!A1:BN12000
+    used_range = graph_request('GET', f'{worksheet_url}/usedRange?$select=address', token_source(), 'worksheets')
+    used_range.raise_for_status()
+    first_column, first_row, last_column, last_row = _parse_range_address(used_range.json()['address'])
+
+    cells = (last_row - first_row + 1) * (_column_number(last_column) - _column_number(first_column) + 1)
+    kept = [] if tag and cells <= GRAPH_CACHE_MAX_CELLS else None
+
+    for start in range(first_row, last_row + 1, window_rows):
+        end = min(start + window_rows - 1, last_row)
+        window = graph_request('GET',
+            f"{worksheet_url}/range(address='{first_column}{start}:{last_column}{end}')?$select=values",
+            token_source(), 'file_data')
+        window.raise_for_status()
+        values = window.json()['values']
+        if kept is not None:
+            kept.extend(values)
+        yield values
+
+    if kept is not None:
+        get_worksheet_cache().put(file_id, tag, worksheet_name, kept)
+
+def _column_number(letters):
+    # 'A' -> 1, 'BN' -> 66
+    number = 0
+    for letter in letters:
+        number = number * 26 + ord(letter) - ord('A') + 1
+    return number
+
+def _parse_range_address(address):
+    # "Sheet1!A1:BN12000" -> ('A', 1, 'BN', 12000)
+    cells = address.rsplit('!', 1)[-1].replace('$', '').split(':')
+    first = re.fullmatch(r'([A-Z]+)(\d+)', cells[0])
+    last = re.fullmatch(r'([A-Z]+)(\d+)', cells[-1])
+    return first.group(1), int(first.group(2)), last.group(1), int(last.group(2))
+
+def get_file_content_data(token,drive,file_id,worksheet_name=None,tag=None):
+    # Same result as get_file_data, but downloads the xlsx file and
+    # parses the worksheet locally instead of using the workbook API.
+    # Without a worksheet name the first sheet is read and nothing is
+    # cached, as the cache is keyed on the sheet name.
+    cache = get_worksheet_cache()
+    if worksheet_name is None:
+        tag = None
+    values = cache.get(file_id, tag, worksheet_name)
+    if values is not None:
+        return {'values': values}
+
+    # /content redirects to a pre-authenticated download URL
+    content = graph_request('GET', f'{GRAPH_URL}{drive}/items/{file_id}/content', token, 'content')
+    content.raise_for_status()
+
+    values = read_worksheet_values(content.content, worksheet_name)
+    cache.put(file_id, tag, worksheet_name, values)
+
+    return {'values': values}
 
 def create_event(token, subject, start, end, attendees=None, body=None, timezone='UTC'):
     # Create an event object
@@ -157,14 +496,14 @@ def create_event(token, subject, start, end, attendees=None, body=None, timezone
 
     # Set headers
     headers = {
-        'Authorization': f'Bearer {token}',
         'Content-Type': 'application/json'
     }
 
-    requests.post(f'{GRAPH_URL}/me/events',
+    created = graph_request('POST', f'{GRAPH_URL}/me/events', token, 'event',
         headers=headers,
-        data=json.dumps(new_event),
-        timeout = 100)
+        data=json.dumps(new_event))
+    created.raise_for_status()
+
 
 #/* spell-checker: disable */
 # Basic lookup for mapping Windows time zone identifiers to
@@ -0,0 +1,126 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# Statuses Graph uses for throttling and transient unavailability
+# https://learn.microsoft.com/graph/throttling
+RETRY_STATUSES = {429, 503, 504}
+
+# A 503 or 504 can come back after Graph has already carried out the
+# request, so non-idempotent calls are only retried on 429, which Graph
+# sends before doing any work
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+def retry_statuses(method, url):
+    # The statuses a request may be retried on. $batch is a POST but only
+    # carries the reads this app sends through it.
+    if method.upper() in IDEMPOTENT_METHODS or url.split('?', 1)[0].endswith('/$batch'):
+        return RETRY_STATUSES
+    return {429}
+
+class AdaptiveLimiter:
+    """Concurrency limit for Graph calls, adjusted with AIMD
+
+    Every successful call raises the limit by 1/limit (about one extra
+    slot per window of calls); every throttled call halves it.
+    """
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self._limit = float(maximum)
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= max(self.minimum, int(self._limit)):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, throttled=False):
+        with self._condition:
+            self._in_flight -= 1
+            self._adjust(throttled)
+            self._condition.notify_all()
+
+    def _adjust(self, throttled):
+        if throttled:
+            self._limit = max(self.minimum, self._limit / 2)
+        else:
+            self._limit = min(self.maximum, self._limit + 1 / self._limit)
+
+class AsyncAdaptiveLimiter(AdaptiveLimiter):
+    """AdaptiveLimiter for coroutines on one event loop
+
+    Waiting for a slot yields the loop instead of blocking its thread.
+    release() does not wait, so it is safe in a finally block of a
+    cancelled task.
+    """
+
+    def __init__(self, maximum, minimum=1):
+        super().__init__(maximum, minimum)
+        self._condition = None
+        self._waiters = []
+
+    async def acquire(self):
+        while self._in_flight >= max(self.minimum, int(self._limit)):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self._in_flight += 1
+
+    def release(self, throttled=False):
+        self._in_flight -= 1
+        self._adjust(throttled)
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+class GraphStats:
+    """Thread-safe counters for Graph requests, retries and throttling"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {'requests': 0, 'retries': 0, 'throttled': 0}
+
+    def increment(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        with self._lock:
+            for name in self._counts:
+                self._counts[name] = 0
+
+def retry_delay(retry_after, attempt, base, cap):
+    # Honour Retry-After when Graph sends it, otherwise use exponential
+    # backoff with full jitter
+    if retry_after:
+        try:
+            return min(cap, max(0.0, float(retry_after)))
+        except ValueError:
+            try:
+                return min(cap, max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()))
+            except (TypeError, ValueError):
+                pass
+
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
@@ -0,0 +1,264 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from graph_connector_app.bulk_loader import (STAGING_LOAD_MODE, CheckpointedReplace,
+                                  replace_table_rows, table_lock)
+from graph_connector_app.graph_helper import (GRAPH_INGEST_MODE, GRAPH_MAX_IN_FLIGHT,
+                                   GRAPH_WINDOW_ROWS, get_file_content_data,
+                                   iter_file_data_windows)
+from graph_connector_app.type_coercion import TableCoercer
+
+logger = logging.getLogger(__name__)
+
+# Row windows of each file allowed to wait between its fetch worker and
+# the insert stage. At most max_in_flight * (PIPELINE_QUEUE_WINDOWS + 1)
+# + 1 windows of GRAPH_WINDOW_ROWS rows are held at once, however many
+# files there are.
+# Override with the PIPELINE_QUEUE_WINDOWS environment variable.
+PIPELINE_QUEUE_WINDOWS = int(os.environ.get('PIPELINE_QUEUE_WINDOWS', '2'))
+
+# Whether swap loads on SQL Server commit and checkpoint file by file, so
+# a failed run resumes from the first file it did not finish. Override
+# with the INGEST_CHECKPOINTS environment variable ('0' to turn off).
+INGEST_CHECKPOINTS = os.environ.get('INGEST_CHECKPOINTS', '1') == '1'
+
+class PipelineCounts:
+    """Totals reported by an ingestion run in place of the rows themselves"""
+
+    def __init__(self):
+        self.files = 0
+        # files a resumed run found already loaded
+        self.files_resumed = 0
+        self.windows = 0
+        self.rows_fetched = 0
+        self.rows_dropped = 0
+        # reason -> rows dropped for it
+        self.drop_reasons = {}
+        self.rows_loaded = 0
+        # inserted/updated/deleted/unchanged totals of a merge load
+        self.changes = None
+        # worksheet header -> files it matched no table column in, and
+        # table column -> files with no header for it (loaded as NULL)
+        self.headers_ignored = {}
+        self.columns_missing = {}
+        self.seconds = 0.0
+
+    def drop(self, reason, rows=1):
+        self.rows_dropped += rows
+        self.drop_reasons[reason] = self.drop_reasons.get(reason, 0) + rows
+
+    def unmatched(self, headers, columns, files=1):
+        for header in headers:
+            self.headers_ignored[header] = self.headers_ignored.get(header, 0) + files
+        for column in columns:
+            self.columns_missing[column] = self.columns_missing.get(column, 0) + files
+
+    def as_dict(self):
+        return dict(vars(self), drop_reasons=dict(self.drop_reasons),
+                    headers_ignored=dict(self.headers_ignored), columns_missing=dict(self.columns_missing))
+
+    def add(self, other):
+        for name in ('files', 'files_resumed', 'windows', 'rows_fetched', 'rows_dropped', 'rows_loaded'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for reason, rows in other.drop_reasons.items():
+            self.drop_reasons[reason] = self.drop_reasons.get(reason, 0) + rows
+        for header, files in other.headers_ignored.items():
+            self.headers_ignored[header] = self.headers_ignored.get(header, 0) + files
+        for column, files in other.columns_missing.items():
+            self.columns_missing[column] = self.columns_missing.get(column, 0) + files
+
+class _Failure:
+    def __init__(self, exc):
+        self.exc = exc
+
+_FILE_DONE = object()
+
+def run_ingest_pipeline(token_source, drive, file_info_list, connection, table, prefix, drop_rules=None,
+                        max_in_flight=None, mode=None, load_mode=None, progress=None):
+    # Replace the rows of table with every worksheet in file_info_list:
+    #   fetch windows -> coerce to table columns -> filter -> bulk insert
+    # token_source is called for an app token before each Graph request,
+    # so a long run never outlives its token.
+    # Each entry of file_info_list needs 'id' and 'WorksheetName' and may
+    # carry 'cTag'. prefix(file) gives the values of the leading table
+    # columns that do not come from the worksheet. Header rows and rows
+    # with a blank key column are always dropped; drop_rules maps further
+    # reasons to predicates over the coerced row. mode picks how workbooks
+    # are read and load_mode how the table is replaced (see
+    # replace_table_rows). progress, if given, is called with the running
+    # PipelineCounts after each window. Returns a PipelineCounts.
+    if (INGEST_CHECKPOINTS and (load_mode or STAGING_LOAD_MODE) == 'swap'
+            and connection.dialect.name == 'mssql'):
+        return run_checkpointed_pipeline(token_source, drive, file_info_list, connection, table, prefix,
+                                         drop_rules, max_in_flight, mode, progress)
+
+    counts = PipelineCounts()
+    start = time.perf_counter()
+    rows = ingest_rows(token_source, drive, file_info_list, table, prefix, counts, drop_rules,
+                       max_in_flight, mode, progress)
+
+    try:
+        result = replace_table_rows(connection, table, rows, load_mode)
+    finally:
+        rows.close()
+
+    counts.rows_loaded = result.rows
+    counts.changes = result.changes
+    counts.seconds = time.perf_counter() - start
+    logger.info('Ingested %s: %s', table.fullname, counts.as_dict())
+    return counts
+
+def run_checkpointed_pipeline(token_source, drive, file_info_list, connection, table, prefix,
+                              drop_rules=None, max_in_flight=None, mode=None, progress=None):
+    # As run_ingest_pipeline in swap mode, but each file is fetched and
+    # committed to the shadow table on its own pooled connection along
+    # with its checkpoint. Files a failed earlier run committed are
+    # skipped, and the shadow is switched in once every file is loaded.
+    counts = PipelineCounts()
+    counts_lock = threading.Lock()
+    start = time.perf_counter()
+    replace = CheckpointedReplace(table)
+
+    def load_file(file):
+        file_counts = PipelineCounts()
+        rows = ingest_rows(token_source, drive, [file], table, prefix, file_counts, drop_rules, 1, mode)
+        try:
+            with connection.engine.connect() as file_connection:
+                try:
+                    result = replace.load_file(file_connection, file, rows)
+                except Exception:
+                    replace.record_failure(file_connection, file)
+                    raise
+        finally:
+            rows.close()
+
+        file_counts.rows_loaded = result.rows
+        with counts_lock:
+            counts.add(file_counts)
+            if progress is not None:
+                progress(counts)
+
+    with table_lock(connection, table):
+        pending = replace.begin(connection, file_info_list)
+        counts.files_resumed = len(file_info_list) - len(pending)
+
+        with ThreadPoolExecutor(max_workers=max_in_flight or GRAPH_MAX_IN_FLIGHT) as executor:
+            # Let every file finish or fail so each gets its checkpoint, then
+            # raise the first failure
+            for future in [executor.submit(load_file, file) for file in pending]:
+                future.result()
+
+        replace.finish(connection)
+    counts.seconds = time.perf_counter() - start
+    logger.info('Ingested %s: %s', table.fullname, counts.as_dict())
+    return counts
+
+def ingest_rows(token_source, drive, file_info_list, table, prefix, counts, drop_rules=None,
+                max_in_flight=None, mode=None, progress=None):
+    # Yield the coerced rows of every worksheet in file_info_list that
+    # survive the drop rules, without loading them anywhere. Arguments are
+    # as for run_ingest_pipeline; counts is updated as rows go by.
+    coercer = TableCoercer(table, len(prefix(file_info_list[0])) if file_info_list else 0)
+
+    key_index = coercer.key_index
+    rules = {f'blank_{table.columns[key_index].name}': lambda row: row[key_index] in ('', None)}
+    rules.update(drop_rules or {})
+
+    windows = fetch_windows(token_source, drive, file_info_list, counts, max_in_flight, mode)
+    try:
+        yield from filter_rows(coerce_windows(windows, prefix, coercer, counts, progress), rules, counts)
+    finally:
+        windows.close()
+
+def fetch_windows(token_source, drive, file_info_list, counts, max_in_flight=None, mode=None):
+    # Yield (file, rows) windows file by file in file_info_list order,
+    # while up to max_in_flight files are fetched ahead. Each file's
+    # windows wait on a queue of their own; its worker blocks once that
+    # is full, so a slow insert stage holds back the downloads.
+    max_in_flight = max_in_flight or GRAPH_MAX_IN_FLIGHT
+    mode = mode or GRAPH_INGEST_MODE
+    file_windows = [queue.Queue(maxsize=PIPELINE_QUEUE_WINDOWS) for _ in file_info_list]
+    stop = threading.Event()
+
+    def fetch_file(file, windows):
+        try:
+            for window in _file_windows(token_source, drive, file, mode):
+                if not _put(windows, (file, window), stop):
+                    return
+        except Exception as exc:  # pylint: disable=broad-except
+            _put(windows, _Failure(exc), stop)
+        finally:
+            _put(windows, _FILE_DONE, stop)
+
+    executor = ThreadPoolExecutor(max_workers=max_in_flight)
+    try:
+        # Files start in list order, so the file being read out has always
+        # been started before any worker blocks on a later one
+        for file, windows in zip(file_info_list, file_windows):
+            executor.submit(fetch_file, file, windows)
+
+        for windows in file_windows:
+            while True:
+                item = windows.get()
+                if item is _FILE_DONE:
+                    counts.files += 1
+                    break
+                if isinstance(item, _Failure):
+                    raise item.exc
+                counts.windows += 1
+                yield item
+    finally:
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def _file_windows(token_source, drive, file, mode):
+    if mode == 'download':
+        # The whole workbook is downloaded anyway, so only the slices
+        # handed downstream are bounded
+        values = get_file_content_data(token_source(), drive, file['id'], file['WorksheetName'], file.get('cTag'))['values']
+        for start in range(0, len(values), GRAPH_WINDOW_ROWS):
+            yield values[start:start + GRAPH_WINDOW_ROWS]
+        return
+
+    yield from iter_file_data_windows(token_source, drive, file['id'], file['WorksheetName'], file.get('cTag'))
+
+def _put(windows, item, stop):
+    # Block until there is room on the queue, giving up if the consumer stopped
+    while not stop.is_set():
+        try:
+            windows.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def coerce_windows(windows, prefix, coercer, counts, progress=None):
+    for file, window in windows:
+        if progress is not None:
+            progress(counts)
+        counts.rows_fetched += len(window)
+        rows, dropped, unmatched = coercer.coerce(file, prefix(file), window)
+        if dropped:
+            counts.drop('header_row', dropped)
+        if unmatched is not None:
+            counts.unmatched(*unmatched)
+        yield from rows
+
+def filter_rows(rows, rules, counts):
+    # One pass, no list shifting: each row is kept or counted against the
+    # first rule that matches it
+    rules = list(rules.items())
+    for row in rows:
+        for reason, rule in rules:
+            if rule(row):
+                counts.drop(reason)
+                break
+        else:
+            yield row
@@ -0,0 +1,164 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.db import close_old_connections, connection
+from django.db.models import Q
+from django.utils import timezone
+from graph_connector_app.models import IngestJob
+
+logger = logging.getLogger(__name__)
+
+# Jobs run at once in each web process, and the least time between
+# progress writes for a job. Override with the JOB_WORKERS environment variable.
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+JOB_PROGRESS_INTERVAL = 1.0
+
+# Seconds between the heartbeats each process writes for its queued and
+# running jobs, and seconds without one after which a job's process is
+# taken to have died and the job is marked failed.
+JOB_HEARTBEAT_INTERVAL = 30
+JOB_STALE_AFTER = 120
+
+_executor = None
+_executor_lock = threading.Lock()
+_monitor = None
+
+def get_job_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='ingest-job')
+    start_job_monitor()
+    return _executor
+
+def start_job_monitor():
+    # Start this process's heartbeat thread if it is not running. Its
+    # first pass fails the jobs of processes that died or were restarted.
+    global _monitor
+    with _executor_lock:
+        if _monitor is None:
+            _monitor = threading.Thread(target=_monitor_jobs, name='ingest-job-monitor', daemon=True)
+            _monitor.start()
+
+def _worker_id():
+    # Read per call: a gunicorn worker forked from a preloaded master
+    # must not share its id
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def _monitor_jobs():
+    while True:
+        close_old_connections()
+        try:
+            IngestJob.objects.filter(worker=_worker_id(), status__in=[IngestJob.QUEUED, IngestJob.RUNNING]) \
+                .update(heartbeat=timezone.now())
+            recover_orphaned_jobs()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Could not record job heartbeats')
+        finally:
+            connection.close()
+        time.sleep(JOB_HEARTBEAT_INTERVAL)
+
+def recover_orphaned_jobs():
+    # Mark failed the queued or running jobs whose process has stopped
+    # sending heartbeats; nothing will ever finish them. Returns how many.
+    now = timezone.now()
+    orphaned = IngestJob.objects.filter(status__in=[IngestJob.QUEUED, IngestJob.RUNNING]).filter(
+        Q(heartbeat__isnull=True) | Q(heartbeat__lt=now - timedelta(seconds=JOB_STALE_AFTER)))
+    failed = orphaned.update(status=IngestJob.FAILED, finished=now,
+                             error='The process running this job stopped before it finished')
+    if failed:
+        logger.warning('Marked %s job(s) of stopped processes failed', failed)
+    return failed
+
+class JobProgress:
+    """Handed to a running job so it can publish progress to its IngestJob row
+
+    report() may be called from any of the job's threads. It only keeps
+    the latest value; the job's own thread writes it to the database
+    every JOB_PROGRESS_INTERVAL, so worker threads never open Django
+    database connections.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latest = None
+        self._changed = False
+
+    def report(self, progress):
+        with self._lock:
+            self._latest = progress
+            self._changed = True
+
+    def take(self):
+        # The progress reported since the last take, or None
+        with self._lock:
+            if not self._changed:
+                return None
+            self._changed = False
+            return self._latest
+
+def submit_job(kind, function, **params):
+    # Record a queued job and run function(progress, **params) on the job
+    # pool. params must be JSON serialisable; the function's return value
+    # is stored as the job result.
+    job = IngestJob.objects.create(kind=kind, params=params, worker=_worker_id(), heartbeat=timezone.now())
+    get_job_executor().submit(_run_job, job.pk, function, params)
+    return job
+
+def _run_job(job_id, function, params):
+    close_old_connections()
+    jobs = IngestJob.objects.filter(pk=job_id)
+    try:
+        jobs.update(status=IngestJob.RUNNING, started=timezone.now())
+        progress = JobProgress()
+        # The function runs on a helper thread so this one is free to
+        # write its progress
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'ingest-job-{job_id}') as runner:
+            future = runner.submit(function, progress, **params)
+            while not wait([future], timeout=JOB_PROGRESS_INTERVAL).done:
+                _write_progress(jobs, progress)
+        _write_progress(jobs, progress)
+
+        try:
+            result = future.result()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Job %s failed', job_id)
+            _fail(jobs, traceback.format_exc())
+            return
+
+        try:
+            jobs.update(status=IngestJob.SUCCEEDED, result=result, finished=timezone.now())
+        except Exception:  # pylint: disable=broad-except
+            # e.g. a result that is not JSON serialisable
+            logger.exception('Could not record the result of job %s', job_id)
+            _fail(jobs, traceback.format_exc())
+    except Exception:  # pylint: disable=broad-except
+        logger.exception('Job %s could not be run', job_id)
+        _fail(jobs, traceback.format_exc())
+    finally:
+        # Job threads outlive requests, so close their own DB connection
+        connection.close()
+
+def _write_progress(jobs, progress):
+    latest = progress.take()
+    if latest is not None:
+        try:
+            jobs.update(progress=latest)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Could not record job progress')
+
+def _fail(jobs, error):
+    try:
+        jobs.update(status=IngestJob.FAILED, error=error, finished=timezone.now())
+    except Exception:  # pylint: disable=broad-except
+        logger.exception('Could not mark job failed')
@@ -0,0 +1,106 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+# Seconds a folder listing is served from memory before it is listed
+# again. Override with the LISTING_CACHE_TTL environment variable, or per
+# path with ListingCache.set_ttl.
+LISTING_CACHE_TTL = int(os.environ.get('LISTING_CACHE_TTL', '60'))
+
+# Listings held at once; the least recently loaded are dropped first.
+# Override with the LISTING_CACHE_MAX_ENTRIES environment variable.
+LISTING_CACHE_MAX_ENTRIES = int(os.environ.get('LISTING_CACHE_MAX_ENTRIES', '1000'))
+
+class ListingCache:
+    """Folder listings kept in memory for a TTL per path
+
+    Concurrent misses for the same path share one load: the first caller
+    runs it and the others wait for its result. Values are shared between
+    callers, so they must not be changed after they are returned. At most
+    max_entries listings are kept.
+    """
+
+    def __init__(self, ttl=LISTING_CACHE_TTL, max_entries=LISTING_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._ttls = {}
+        # path -> (expires at, value)
+        self._entries = {}
+        # path -> Future of the load in flight
+        self._in_flight = {}
+        # bumped by invalidate so loads started before it are not stored
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def set_ttl(self, path, ttl):
+        self._ttls[path] = ttl
+
+    def peek(self, path):
+        # Return the cached listing for path, or None if it is missing or expired
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def get(self, path, load):
+        # Return the cached listing for path, calling load() to fill it on a miss
+        value = self.peek(path)
+        if value is not None:
+            return value
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+            future = self._in_flight.get(path)
+            leader = future is None
+            if leader:
+                future = self._in_flight[path] = Future()
+                generation = self._generation
+
+        if not leader:
+            return future.result()
+
+        try:
+            value = load()
+        except BaseException as exc:
+            with self._lock:
+                del self._in_flight[path]
+            future.set_exception(exc)
+            raise
+
+        with self._lock:
+            del self._in_flight[path]
+            if generation == self._generation:
+                # Re-inserted so the dict stays in load order, oldest first
+                self._entries.pop(path, None)
+                self._entries[path] = (time.monotonic() + self._ttls.get(path, self.ttl), value)
+                while len(self._entries) > self.max_entries:
+                    del self._entries[next(iter(self._entries))]
+        future.set_result(value)
+        return value
+
+    def invalidate(self, path=None):
+        # Forget one path, or every path when none is given
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+            self._generation += 1
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_listing_cache():
+    # Return the process-wide listing cache, creating it on first use
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ListingCache()
+    return _cache
@@ -1,7 +1,9 @@
 import configparser
 import os
+import threading
 import sqlalchemy as sa
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
 from sqlalchemy import Integer, Column, String, Date, Numeric
 from pathlib import Path
 
@@ -13,36 +15,58 @@ Config = configparser.ConfigParser()
 working_directory = os.getcwd()
 Config.read('./settings.ini')
 
-class DatabaseConnection:
-    """Connect to SQL Server Domo Database"""
-    _db_connection = None
-    _db_cur = None
+# Connection pool sizing. Override with the DB_POOL_SIZE, DB_MAX_OVERFLOW
+# and DB_POOL_RECYCLE (seconds) environment variables.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '20'))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', '1800'))
 
-    def __init__(self):
-        self.connectionstring = "mssql+pyodbc://" + Config.get('DomoDB','username') + ":" \
-                                + Config.get('DomoDB','password') + "@"\
-                                + Config.get('DomoDB','server') + ":" \
-                                + Config.get('DomoDB','port') + "/"\
-                                + Config.get('DomoDB','database') \
-                                + "?Encrypt=yes&TrustServerCertificate=yes" + "&" \
-                                + Config.get('DomoDB', 'driver')
+class DatabaseConnection:
+    """Connect to SQL Server Domo Database
 
+    The engine and its connection pool are created on first use. Check a
+    connection out of the pool for each unit of work with connect().
+    """
 
-        self.engine = sa.create_engine(self.connectionstring)
-        self.connection = self.engine.connect()
+    def __init__(self):
+        self._engine = None
+        self._lock = threading.Lock()
+
+    @property
+    def connectionstring(self):
+        return "mssql+pyodbc://" + Config.get('DomoDB','username') + ":" \
+               + Config.get('DomoDB','password') + "@"\
+               + Config.get('DomoDB','server') + ":" \
+               + Config.get('DomoDB','port') + "/"\
+               + Config.get('DomoDB','database') \
+               + "?Encrypt=yes&TrustServerCertificate=yes" + "&" \
+               + Config.get('DomoDB', 'driver')
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            with self._lock:
+                if self._engine is None:
+                    # pre_ping replaces connections the server has dropped
+                    self._engine = sa.create_engine(self.connectionstring,
+                                                    poolclass=QueuePool,
+                                                    pool_size=DB_POOL_SIZE,
+                                                    max_overflow=DB_MAX_OVERFLOW,
+                                                    pool_recycle=DB_POOL_RECYCLE,
+                                                    pool_pre_ping=True)
+        return self._engine
+
+    def connect(self):
+        # A pooled connection, returned to the pool when the with block ends
+        return self.engine.connect()
 
 
 # define declarative base
 Base = declarative_base()
 
-# create an engine
+# create an engine on first use
 db = DatabaseConnection()
 
-# reflect current database engine to metadata
-# metadata = sa.MetaData(db.engine)
-metadata = sa.MetaData(db.engine)
-metadata.reflect()
-
 # build your ReadingiReady class on existing `AI.ReadingiReadyStaging` table
 class ReadingiReady(Base):
     """Reading iReady Model"""
@@ -218,9 +242,8 @@ class LoadProduction:
    
     def load_production_tables(self):
 
-        db = DatabaseConnection()
-        
-        trans = db.connection.begin()
-        db.connection.execute("AI.AILoadTables")
-        trans.commit()
+        with db.connect() as connection:
+            trans = connection.begin()
+            connection.execute("AI.AILoadTables")
+            trans.commit()
 
@@ -1,3 +1,566 @@
-from django.test import TestCase
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import date
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import msal
+import sqlalchemy as sa
+from django.test import SimpleTestCase
+
+from graph_connector_app.bulk_loader import _delta_rows, _resume_pending, _row_hash, _rows_before_duplicate
+from graph_connector_app.drive_sync import DriveMirror
+from graph_connector_app.graph_helper import GRAPH_BATCH_LIMIT, _chunk_batch_items
+from graph_connector_app.graph_throttle import AdaptiveLimiter, retry_delay, retry_statuses
+from graph_connector_app.ingest_pipeline import PipelineCounts, fetch_windows, filter_rows
+from graph_connector_app.listing_cache import ListingCache
+from graph_connector_app.token_cache import SQLiteTokenCacheBackend, TokenCacheStore, cached_access_token
+from graph_connector_app.type_coercion import TableCoercer
+from graph_connector_app.xlsx_reader import read_worksheet_values
+
+
+def _batch_item(item_id, *depends_on):
+    item = {'id': item_id, 'method': 'GET', 'url': f'/items/{item_id}'}
+    if depends_on:
+        item['dependsOn'] = list(depends_on)
+    return item
+
+class ChunkBatchItemsTests(SimpleTestCase):
+
+    def test_independent_items_fill_chunks_up_to_the_limit(self):
+        items = [_batch_item(str(index)) for index in range(GRAPH_BATCH_LIMIT * 2 + 1)]
+        chunks = list(_chunk_batch_items(items))
+        self.assertEqual([len(chunk) for chunk in chunks], [GRAPH_BATCH_LIMIT, GRAPH_BATCH_LIMIT, 1])
+        self.assertEqual([item for chunk in chunks for item in chunk], items)
+
+    def test_depends_on_chain_stays_in_one_chunk(self):
+        items = [_batch_item(str(index)) for index in range(GRAPH_BATCH_LIMIT - 1)]
+        items += [_batch_item('a'), _batch_item('b', 'a'), _batch_item('c', 'b')]
+        chunks = list(_chunk_batch_items(items))
+        chain = [chunk for chunk in chunks if any(item['id'] == 'a' for item in chunk)]
+        self.assertEqual(len(chain), 1)
+        self.assertTrue({'a', 'b', 'c'} <= {item['id'] for item in chain[0]})
+        self.assertTrue(all(len(chunk) <= GRAPH_BATCH_LIMIT for chunk in chunks))
+
+    def test_unknown_dependency_is_rejected(self):
+        with self.assertRaises(ValueError):
+            list(_chunk_batch_items([_batch_item('b', 'a'), _batch_item('a')]))
+
+    def test_chain_longer_than_the_limit_is_rejected(self):
+        items = [_batch_item('0')]
+        items += [_batch_item(str(index), str(index - 1)) for index in range(1, GRAPH_BATCH_LIMIT + 1)]
+        with self.assertRaises(ValueError):
+            list(_chunk_batch_items(items))
+
+class RetryTests(SimpleTestCase):
+
+    def test_retry_after_seconds_are_honoured_up_to_the_cap(self):
+        self.assertEqual(retry_delay('3', 0, 1, 60), 3.0)
+        self.assertEqual(retry_delay('120', 0, 1, 60), 60)
+        self.assertEqual(retry_delay('-5', 0, 1, 60), 0.0)
+
+    def test_retry_after_http_date(self):
+        with mock.patch('graph_connector_app.graph_throttle.time.time', return_value=784111767.0):
+            # 10 seconds after the patched clock
+            self.assertAlmostEqual(retry_delay('Sun, 06 Nov 1994 08:49:37 GMT', 0, 1, 60), 10.0)
+
+    def test_backoff_has_full_jitter_within_the_cap(self):
+        with mock.patch('graph_connector_app.graph_throttle.random.uniform', side_effect=lambda low, high: high):
+            self.assertEqual(retry_delay(None, 0, 1, 60), 1)
+            self.assertEqual(retry_delay(None, 3, 1, 60), 8)
+            self.assertEqual(retry_delay('not a delay', 10, 1, 60), 60)
+
+    def test_only_idempotent_requests_and_batch_retry_unavailable(self):
+        self.assertEqual(retry_statuses('GET', 'https://graph/v1.0/me'), {429, 503, 504})
+        self.assertEqual(retry_statuses('POST', 'https://graph/v1.0/$batch'), {429, 503, 504})
+        self.assertEqual(retry_statuses('POST', 'https://graph/v1.0/me/events'), {429})
+
+class AdaptiveLimiterTests(SimpleTestCase):
+
+    def test_throttling_halves_the_limit_and_success_grows_it_back(self):
+        limiter = AdaptiveLimiter(8)
+        limiter.acquire()
+        limiter.release(throttled=True)
+        self.assertEqual(limiter.limit, 4)
+        # +1/limit per success: 4.25, 4.49, 4.71, 4.92, 5.12
+        for _ in range(5):
+            limiter.acquire()
+            limiter.release()
+        self.assertEqual(limiter.limit, 5)
+
+    def test_limit_stays_within_its_bounds(self):
+        limiter = AdaptiveLimiter(2, minimum=1)
+        for _ in range(5):
+            limiter.acquire()
+            limiter.release(throttled=True)
+        self.assertEqual(limiter.limit, 1)
+        for _ in range(50):
+            limiter.acquire()
+            limiter.release()
+        self.assertEqual(limiter.limit, 2)
+
+    def test_acquire_waits_for_a_free_slot(self):
+        limiter = AdaptiveLimiter(1)
+        limiter.acquire()
+        acquired = threading.Event()
+
+        def waiter():
+            limiter.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        self.assertFalse(acquired.wait(0.05))
+        limiter.release()
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+
+def _xlsx(cells, sheet_name='Data', shared_strings=()):
+    # A minimal xlsx package with one worksheet; cells is a string of <c>
+    # elements grouped in <row> elements
+    main = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+    rel = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+    package = 'http://schemas.openxmlformats.org/package/2006/relationships'
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, 'w') as archive:
+        archive.writestr('xl/workbook.xml',
+            f'<workbook xmlns="{main}" xmlns:r="{rel}"><sheets>'
+            f'<sheet name="Other" sheetId="1" r:id="rId1"/>'
+            f'<sheet name="{sheet_name}" sheetId="2" r:id="rId2"/></sheets></workbook>')
+        archive.writestr('xl/_rels/workbook.xml.rels',
+            f'<Relationships xmlns="{package}">'
+            f'<Relationship Id="rId1" Target="worksheets/sheet1.xml"/>'
+            f'<Relationship Id="rId2" Target="worksheets/sheet2.xml"/></Relationships>')
+        archive.writestr('xl/worksheets/sheet1.xml',
+            f'<worksheet xmlns="{main}"><sheetData><row r="1"><c r="A1"><v>1</v></c></row></sheetData></worksheet>')
+        archive.writestr('xl/worksheets/sheet2.xml',
+            f'<worksheet xmlns="{main}"><sheetData>{cells}</sheetData></worksheet>')
+        if shared_strings:
+            archive.writestr('xl/sharedStrings.xml',
+                f'<sst xmlns="{main}">' + ''.join(f'<si><t>{text}</t></si>' for text in shared_strings) + '</sst>')
+    return content.getvalue()
+
+class ReadWorksheetValuesTests(SimpleTestCase):
+
+    def test_used_range_is_trimmed_and_rectangular(self):
+        content = _xlsx(
+            '<row r="2"><c r="B2" t="s"><v>0</v></c><c r="C2" t="s"><v>1</v></c></row>'
+            '<row r="3"><c r="B3"><v>42</v></c><c r="D3"><v>1.5</v></c></row>'
+            '<row r="5"><c r="C5" t="inlineStr"><is><t>inline</t></is></c><c r="D5" t="b"><v>1</v></c></row>',
+            shared_strings=('Name', 'Score'))
+        self.assertEqual(read_worksheet_values(content, 'Data'), [
+            ['Name', 'Score', ''],
+            [42, '', 1.5],
+            ['', '', ''],
+            ['', 'inline', True],
+        ])
+
+    def test_cells_without_references_use_the_row_number(self):
+        content = _xlsx(
+            '<row r="1"><c><v>1</v></c><c><v>2</v></c></row>'
+            '<row r="3"><c><v>3</v></c><c r="C3"><v>4</v></c><c><v>5</v></c></row>'
+            '<row><c><v>6</v></c></row>')
+        self.assertEqual(read_worksheet_values(content, 'Data'), [
+            [1, 2, '', ''],
+            ['', '', '', ''],
+            [3, '', 4, 5],
+            [6, '', '', ''],
+        ])
+
+    def test_unknown_sheet_name_reads_the_first_sheet(self):
+        content = _xlsx('<row r="1"><c r="A1"><v>2</v></c></row>')
+        self.assertEqual(read_worksheet_values(content, 'Missing'), [[1]])
+        self.assertEqual(read_worksheet_values(content), [[1]])
+
+    def test_empty_sheet(self):
+        self.assertEqual(read_worksheet_values(_xlsx(''), 'Data'), [])
+
+def _staging_table():
+    return sa.Table('Staging', sa.MetaData(),
+                    sa.Column('District', sa.String),
+                    sa.Column('StudentId', sa.String, primary_key=True),
+                    sa.Column('Score', sa.Integer),
+                    sa.Column('Percent', sa.Numeric),
+                    sa.Column('TestDate', sa.Date),
+                    sa.Column('Notes', sa.String))
+
+class TableCoercerTests(SimpleTestCase):
+
+    def test_columns_are_matched_by_header_and_typed(self):
+        coercer = TableCoercer(_staging_table(), 1)
+        window = [
+            ['Test Date', 'Score', 'Student ID', 'Percent', 'Teacher'],
+            [45000, 7.0, 'S1', '12.5%', 'Smith'],
+            ['03/15/2023', '8', 'S2', 3, ''],
+        ]
+        with self.assertLogs('graph_connector_app.type_coercion', 'WARNING'):
+            rows, dropped, unmatched = coercer.coerce({'id': 'f'}, ['North'], window)
+        self.assertEqual(dropped, 1)
+        self.assertEqual(unmatched, (['Teacher'], ['Notes']))
+        self.assertEqual(rows, [
+            ('North', 'S1', 7, Decimal('12.5'), date(2023, 3, 15), None),
+            ('North', 'S2', 8, 3, date(2023, 3, 15), None),
+        ])
+
+    def test_repeated_header_rows_are_dropped(self):
+        coercer = TableCoercer(_staging_table(), 1)
+        header = ['StudentId', 'Score', 'Percent', 'TestDate', 'Notes']
+        coercer.coerce({'id': 'f'}, ['North'], [header, ['S1', 1, 1, None, 'a']])
+        rows, dropped, unmatched = coercer.coerce({'id': 'f'}, ['North'], [header, ['S2', 2, 2, None, 'b']])
+        self.assertEqual(dropped, 1)
+        self.assertIsNone(unmatched)
+        self.assertEqual([row[1] for row in rows], ['S2'])
+
+    def test_without_a_header_columns_are_taken_in_table_order(self):
+        coercer = TableCoercer(_staging_table(), 1)
+        with self.assertLogs('graph_connector_app.type_coercion', 'WARNING'):
+            rows, dropped, unmatched = coercer.coerce({'id': 'f'}, ['North'], [['S1', 5, 0.5, '', 'n']])
+        self.assertEqual((dropped, unmatched), (0, None))
+        self.assertEqual(rows, [('North', 'S1', 5, 0.5, None, 'n')])
+
+    def test_boolean_cells_become_integers(self):
+        coercer = TableCoercer(_staging_table(), 1)
+        header = ['StudentId', 'Score', 'Percent', 'TestDate', 'Notes']
+        rows, _, _ = coercer.coerce({'id': 'f'}, ['North'], [header, ['S1', True, 1, None, 'a'],
+                                                              ['S2', False, 1, None, 'b']])
+        self.assertEqual([row[2] for row in rows], [1, 0])
+
+class FilterRowsTests(SimpleTestCase):
+
+    def test_rows_are_dropped_by_the_first_matching_rule(self):
+        counts = PipelineCounts()
+        rules = {'blank': lambda row: row[0] == '', 'negative': lambda row: row[1] < 0}
+        kept = list(filter_rows([('a', 1), ('', -1), ('b', -2), ('c', 3)], rules, counts))
+        self.assertEqual(kept, [('a', 1), ('c', 3)])
+        self.assertEqual(counts.rows_dropped, 2)
+        self.assertEqual(counts.drop_reasons, {'blank': 1, 'negative': 1})
+
+class FetchWindowsTests(SimpleTestCase):
+
+    @mock.patch('graph_connector_app.ingest_pipeline._file_windows')
+    def test_windows_come_out_in_file_order(self, file_windows):
+        def windows(token_source, drive, file, mode):
+            # The first file is the slowest to arrive
+            for number in range(3):
+                time.sleep(0.02 if file['id'] == 'a' else 0)
+                yield [[file['id'], number]]
+
+        file_windows.side_effect = windows
+        counts = PipelineCounts()
+        files = [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}]
+        result = [window for _, window in fetch_windows(lambda: 'token', 'drive', files, counts, max_in_flight=3)]
+        self.assertEqual(result, [[[file_id, number]] for file_id in 'abc' for number in range(3)])
+        self.assertEqual((counts.files, counts.windows), (3, 9))
+
+    @mock.patch('graph_connector_app.ingest_pipeline._file_windows')
+    def test_failure_is_raised(self, file_windows):
+        file_windows.side_effect = RuntimeError('boom')
+        with self.assertRaises(RuntimeError):
+            list(fetch_windows(lambda: 'token', 'drive', [{'id': 'a'}], PipelineCounts()))
+
+class ListingCacheTests(SimpleTestCase):
+
+    def test_concurrent_misses_share_one_load(self):
+        cache = ListingCache(ttl=60)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def load():
+            calls.append(1)
+            started.set()
+            release.wait(1)
+            return ['listing']
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get('path', load))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        started.wait(1)
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['listing']] * 5)
+        self.assertEqual(cache.peek('path'), ['listing'])
+
+    def test_failed_load_is_not_cached(self):
+        cache = ListingCache(ttl=60)
+        with self.assertRaises(RuntimeError):
+            cache.get('path', mock.Mock(side_effect=RuntimeError))
+        self.assertEqual(cache.get('path', lambda: ['again']), ['again'])
+
+    def test_load_started_before_invalidate_is_not_stored(self):
+        cache = ListingCache(ttl=60)
+
+        def load():
+            cache.invalidate()
+            return ['stale']
+
+        self.assertEqual(cache.get('path', load), ['stale'])
+        self.assertIsNone(cache.peek('path'))
+
+    def test_least_recently_loaded_entries_are_dropped(self):
+        cache = ListingCache(ttl=60, max_entries=2)
+        for path in ('a', 'b', 'c'):
+            cache.get(path, lambda path=path: [path])
+        self.assertIsNone(cache.peek('a'))
+        self.assertEqual((cache.peek('b'), cache.peek('c')), (['b'], ['c']))
+
+    def test_expired_entries_are_loaded_again(self):
+        cache = ListingCache(ttl=60)
+        cache.set_ttl('path', 0)
+        cache.get('path', lambda: ['first'])
+        self.assertEqual(cache.get('path', lambda: ['second']), ['second'])
+
+class ResumePendingTests(SimpleTestCase):
+
+    files = [{'id': 'a', 'cTag': '1'}, {'id': 'b', 'cTag': '2'}, {'id': 'c', 'cTag': '3'}]
+
+    def test_unchanged_committed_files_are_skipped(self):
+        self.assertEqual(_resume_pending({'a': '1', 'b': '2'}, self.files), [{'id': 'c', 'cTag': '3'}])
+
+    def test_nothing_committed_starts_over(self):
+        self.assertIsNone(_resume_pending({}, self.files))
+
+    def test_changed_or_removed_file_starts_over(self):
+        self.assertIsNone(_resume_pending({'a': '1', 'b': 'changed'}, self.files))
+        self.assertIsNone(_resume_pending({'a': '1', 'gone': '9'}, self.files))
+
+    def test_unknown_ctag_starts_over(self):
+        self.assertIsNone(_resume_pending({'a': None}, [{'id': 'a'}, {'id': 'b'}]))
+
+class DeltaRowsTests(SimpleTestCase):
+
+    table = sa.Table('Merged', sa.MetaData(),
+                     sa.Column('Id', sa.String, primary_key=True),
+                     sa.Column('Value', sa.Integer))
+
+    def test_rows_are_split_into_inserts_updates_and_deletes(self):
+        stored = {('same',): _row_hash(('same', 1)), ('changed',): _row_hash(('changed', 1)),
+                  ('gone',): _row_hash(('gone', 1))}
+        changes = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+        rows = [('same', 1), ('changed', 2), ('new', 3)]
+        delta = list(_delta_rows(self.table, rows, stored, [0], changes, []))
+        self.assertEqual(delta, [
+            ('changed', 2, _row_hash(('changed', 2)), 'U'),
+            ('new', 3, _row_hash(('new', 3)), 'U'),
+            ('gone', None, None, 'D'),
+        ])
+        self.assertEqual(changes, {'inserted': 1, 'updated': 1, 'deleted': 1, 'unchanged': 1})
+
+    def test_duplicate_key_ends_the_delta(self):
+        changes = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+        duplicates = []
+        rows = iter([('a', 1), ('a', 2), ('c', 3)])
+        delta = list(_delta_rows(self.table, rows, {('b',): b''}, [0], changes, duplicates))
+        self.assertEqual(delta, [('a', 1, _row_hash(('a', 1)), 'U')])
+        self.assertEqual(duplicates, [('a', 2)])
+        self.assertEqual(list(rows), [('c', 3)])
+
+    def test_rows_before_duplicate_are_read_back(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        engine = sa.create_engine(f"sqlite:///{os.path.join(tempdir.name, 'merge.sqlite3')}")
+        self.addCleanup(engine.dispose)
+        metadata = sa.MetaData()
+        table = self.table.to_metadata(metadata)
+        delta = self.table.to_metadata(metadata, name='Merged_Delta')
+        delta.append_column(sa.Column('RowHash', sa.LargeBinary))
+        delta.append_column(sa.Column('ChangeType', sa.String(1)))
+        metadata.create_all(engine)
+
+        with engine.begin() as connection:
+            connection.execute(table.insert(), [{'Id': key, 'Value': 1} for key in ('same', 'changed', 'unseen')])
+            connection.execute(delta.insert(), [
+                {'Id': 'changed', 'Value': 2, 'RowHash': b'', 'ChangeType': 'U'},
+                {'Id': 'new', 'Value': 3, 'RowHash': b'', 'ChangeType': 'U'},
+            ])
+        # 'same' and 'changed' were consumed from stored; 'unseen' was not reached
+        stored = {('unseen',): b''}
+        with engine.connect() as connection:
+            rows = sorted(_rows_before_duplicate(connection, table, delta, stored, [0]))
+        self.assertEqual(rows, [('changed', 2), ('new', 3), ('same', 1)])
+
+def _delta_page(items, next_link=None, delta_link=None):
+    page = {'value': items}
+    if next_link:
+        page['@odata.nextLink'] = next_link
+    if delta_link:
+        page['@odata.deltaLink'] = delta_link
+    return mock.Mock(status_code=200, json=mock.Mock(return_value=page))
+
+_ROOT = {'id': 'root', 'name': 'root', 'root': {}}
+_FOLDER = {'id': 'folder', 'name': 'IT Solutions', 'folder': {}, 'parentReference': {'id': 'root'}}
+
+def _file_item(item_id, name):
+    return {'id': item_id, 'name': name, 'file': {}, 'parentReference': {'id': 'folder'}}
+
+class DriveMirrorTests(SimpleTestCase):
+
+    directory = 'root:/IT Solutions:/children'
+
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.mirror = DriveMirror('/drives/d', lambda: 'token', path=os.path.join(tempdir.name, 'mirror.sqlite3'),
+                                  sync_interval=3600)
+
+    def names(self):
+        return [item['name'] for item in self.mirror.list_children(self.directory)]
+
+    @mock.patch('graph_connector_app.drive_sync.get_listing_cache')
+    @mock.patch('graph_connector_app.drive_sync.graph_request')
+    def test_delta_pages_are_applied(self, graph_request, get_listing_cache):
+        graph_request.side_effect = [
+            _delta_page([_ROOT, _FOLDER, _file_item('b', 'b.xlsx')], next_link='next'),
+            _delta_page([_file_item('a', 'a.xlsx')], delta_link='delta-1'),
+            _delta_page([{'id': 'b', 'deleted': {}}, _file_item('c', 'c.xlsx')], delta_link='delta-2'),
+        ]
+        self.assertEqual(self.mirror.refresh('token'), 4)
+        self.assertTrue(self.mirror.has_synced())
+        with mock.patch.object(self.mirror, 'start'):
+            self.assertEqual(self.names(), ['a.xlsx', 'b.xlsx'])
+            self.assertEqual(self.mirror.list_children(self.directory)[0]['parentReference']['path'],
+                             '/drive/root:/IT Solutions')
+
+            self.assertEqual(self.mirror.refresh('token'), 2)
+            self.assertEqual(self.names(), ['a.xlsx', 'c.xlsx'])
+        urls = [call.args[1] for call in graph_request.call_args_list]
+        self.assertTrue(urls[0].endswith('/drives/d/root/delta'))
+        self.assertEqual(urls[1:], ['next', 'delta-1'])
+        get_listing_cache.return_value.invalidate.assert_called()
+
+    @mock.patch('graph_connector_app.drive_sync.get_listing_cache')
+    @mock.patch('graph_connector_app.drive_sync.graph_request')
+    def test_expired_delta_token_rebuilds_the_mirror(self, graph_request, get_listing_cache):
+        graph_request.side_effect = [
+            _delta_page([_ROOT, _FOLDER, _file_item('old', 'old.xlsx')], delta_link='delta-1'),
+            mock.Mock(status_code=410),
+            _delta_page([_ROOT, _FOLDER, _file_item('new', 'new.xlsx')], delta_link='delta-2'),
+        ]
+        self.mirror.refresh('token')
+        self.mirror.refresh('token')
+        full_sync_url = graph_request.call_args_list[0].args[1]
+        self.assertEqual([call.args[1] for call in graph_request.call_args_list],
+                         [full_sync_url, 'delta-1', full_sync_url])
+        with mock.patch.object(self.mirror, 'start'):
+            self.assertEqual(self.names(), ['new.xlsx'])
+
+    @mock.patch('graph_connector_app.drive_sync.get_listing_cache')
+    @mock.patch('graph_connector_app.drive_sync.graph_request')
+    def test_listing_does_not_wait_for_a_slow_sync(self, graph_request, get_listing_cache):
+        graph_request.return_value = _delta_page([_ROOT, _FOLDER, _file_item('a', 'a.xlsx')], delta_link='delta-1')
+        self.mirror.refresh('token')
+
+        in_sync = threading.Event()
+        release = threading.Event()
+
+        def slow_request(*args, **kwargs):
+            in_sync.set()
+            release.wait(5)
+            return _delta_page([], delta_link='delta-2')
+
+        graph_request.side_effect = slow_request
+        self.addCleanup(release.set)
+        sync = threading.Thread(target=self.mirror.refresh, args=('token',))
+        sync.start()
+        self.assertTrue(in_sync.wait(1))
+
+        listed = []
+        listing = threading.Thread(target=lambda: listed.append(self.names()))
+        listing.start()
+        listing.join(1)
+        self.assertFalse(listing.is_alive())
+        self.assertEqual(listed, [['a.xlsx']])
+
+        release.set()
+        sync.join()
+        # list_children started the background thread; let its first sync
+        # finish before the mirror file goes away
+        deadline = time.monotonic() + 5
+        while graph_request.call_count < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with self.mirror._sync_lock:
+            pass
+
+def _add_access_token(cache, account, secret, expires_in):
+    now = int(time.time())
+    entries = json.loads(cache.serialize())
+    entries.setdefault('AccessToken', {})[f'{account}-token'] = {
+        'credential_type': 'AccessToken', 'secret': secret, 'home_account_id': account,
+        'environment': 'login.microsoftonline.com', 'client_id': 'app', 'realm': 'common',
+        'target': 'user.read', 'cached_at': str(now), 'expires_on': str(now + expires_in)}
+    cache.deserialize(json.dumps(entries))
+    cache.has_state_changed = True
+
+class TokenCacheStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.backend = SQLiteTokenCacheBackend(os.path.join(tempdir.name, 'tokens.sqlite3'))
+
+    def test_cached_access_token_skips_tokens_near_expiry(self):
+        cache = msal.SerializableTokenCache()
+        self.assertIsNone(cached_access_token(cache, 'account', ['user.read']))
+        _add_access_token(cache, 'account', 'expiring', 60)
+        self.assertIsNone(cached_access_token(cache, 'account', ['user.read']))
+        _add_access_token(cache, 'account', 'fresh', 3600)
+        self.assertEqual(cached_access_token(cache, 'account', ['user.read'])['access_token'], 'fresh')
+        self.assertIsNone(cached_access_token(cache, 'other', ['user.read']))
+
+    def test_newer_version_is_reloaded_after_recheck(self):
+        writer = TokenCacheStore(self.backend, recheck=0)
+        reader = TokenCacheStore(self.backend, recheck=60)
+
+        cache = writer.load('account')
+        _add_access_token(cache, 'account', 'first', 3600)
+        writer.save('account', cache)
+        self.assertEqual(cached_access_token(reader.load('account'), 'account', ['user.read'])['access_token'],
+                         'first')
+
+        _add_access_token(cache, 'account', 'second', 3600)
+        writer.save('account', cache)
+        # Within the recheck window the reader serves its copy in memory
+        with mock.patch.object(self.backend, 'version', side_effect=AssertionError), \
+                mock.patch.object(self.backend, 'read', side_effect=AssertionError):
+            self.assertEqual(
+                cached_access_token(reader.load('account'), 'account', ['user.read'])['access_token'], 'first')
+
+        reader.recheck = 0
+        self.assertEqual(cached_access_token(reader.load('account'), 'account', ['user.read'])['access_token'],
+                         'second')
+
+    def test_concurrent_refresh_redeems_once(self):
+        # One store per simulated worker, all sharing the SQLite file
+        stores = [TokenCacheStore(self.backend) for _ in range(4)]
+        redeemed = []
+        tokens = []
+
+        def get_token(store):
+            cache = store.load('account')
+            result = cached_access_token(cache, 'account', ['user.read'])
+            if result is None:
+                with store.locked('account') as cache:
+                    result = cached_access_token(cache, 'account', ['user.read'])
+                    if result is None:
+                        time.sleep(0.05)
+                        redeemed.append(1)
+                        _add_access_token(cache, 'account', 'redeemed', 3600)
+                        result = cached_access_token(cache, 'account', ['user.read'])
+            tokens.append(result['access_token'])
+
+        threads = [threading.Thread(target=get_token, args=(store,)) for store in stores]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(redeemed), 1)
+        self.assertEqual(tokens, ['redeemed'] * 4)
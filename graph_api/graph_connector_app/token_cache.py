@@ -0,0 +1,331 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import fcntl
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import msal
+
+# Where user token caches are stored. A redis:// or rediss:// URL selects
+# the Redis backend; anything else is a SQLite file path.
+# Override with the TOKEN_CACHE_URL environment variable.
+TOKEN_CACHE_URL = os.environ.get('TOKEN_CACHE_URL', 'token_cache.sqlite3')
+
+# Seconds an account's cache is used before checking whether another
+# process has saved a newer one, and seconds an unused account is kept
+# in memory. Override with the TOKEN_CACHE_RECHECK and
+# TOKEN_CACHE_IDLE_TIMEOUT environment variables.
+TOKEN_CACHE_RECHECK = float(os.environ.get('TOKEN_CACHE_RECHECK', '5'))
+TOKEN_CACHE_IDLE_TIMEOUT = int(os.environ.get('TOKEN_CACHE_IDLE_TIMEOUT', '3600'))
+
+# MSAL treats an access token this close to expiry as expired
+ACCESS_TOKEN_EXPIRY_MARGIN = 300
+
+class SQLiteTokenCacheBackend:
+    """Token cache entries in a local SQLite file, one row per entry"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_dir = f'{path}.locks'
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS token_cache_entries (
+                    account TEXT NOT NULL,
+                    field TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (account, field)
+                )""")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS token_cache_versions (
+                    account TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL
+                )""")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def read(self, account):
+        # (entries, version) read in one transaction
+        with self._connect() as conn:
+            entries = {field: json.loads(data) for field, data in conn.execute(
+                "SELECT field, data FROM token_cache_entries WHERE account = ?", (account,))}
+            return entries, self._version(conn, account)
+
+    def version(self, account):
+        with self._connect() as conn:
+            return self._version(conn, account)
+
+    def write(self, account, changed, removed):
+        # Apply the changes and return the account's new version
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO token_cache_entries (account, field, data) VALUES (?, ?, ?)",
+                [(account, field, json.dumps(data)) for field, data in changed.items()])
+            conn.executemany(
+                "DELETE FROM token_cache_entries WHERE account = ? AND field = ?",
+                [(account, field) for field in removed])
+            return self._bump(conn, account)
+
+    def delete(self, account):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM token_cache_entries WHERE account = ?", (account,))
+            self._bump(conn, account)
+
+    def _version(self, conn, account):
+        row = conn.execute("SELECT version FROM token_cache_versions WHERE account = ?", (account,)).fetchone()
+        return row[0] if row else 0
+
+    def _bump(self, conn, account):
+        conn.execute(
+            "INSERT INTO token_cache_versions (account, version) VALUES (?, 1) "
+            "ON CONFLICT (account) DO UPDATE SET version = version + 1", (account,))
+        return self._version(conn, account)
+
+    @contextmanager
+    def lock(self, account):
+        # An exclusive flock per account serialises writers across threads
+        # and gunicorn workers on this host
+        lock_name = hashlib.sha256(account.encode('utf8')).hexdigest()
+        with open(os.path.join(self.lock_dir, f'{lock_name}.lock'), 'a', encoding='utf8') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+class RedisTokenCacheBackend:
+    """Token cache entries in a Redis hash per account, shared across nodes"""
+
+    def __init__(self, client, prefix='msal_token_cache:'):
+        self.client = client
+        self.prefix = prefix
+
+    def read(self, account):
+        # (entries, version) read in one MULTI/EXEC
+        pipeline = self.client.pipeline()
+        pipeline.hgetall(self.prefix + account)
+        pipeline.get(self._version_key(account))
+        entries, version = pipeline.execute()
+        return {_text(field): json.loads(data) for field, data in entries.items()}, int(version or 0)
+
+    def version(self, account):
+        return int(self.client.get(self._version_key(account)) or 0)
+
+    def write(self, account, changed, removed):
+        # Apply the changes and return the account's new version
+        pipeline = self.client.pipeline()
+        if changed:
+            pipeline.hset(self.prefix + account,
+                mapping={field: json.dumps(data) for field, data in changed.items()})
+        if removed:
+            pipeline.hdel(self.prefix + account, *removed)
+        pipeline.incr(self._version_key(account))
+        return pipeline.execute()[-1]
+
+    def delete(self, account):
+        pipeline = self.client.pipeline()
+        pipeline.delete(self.prefix + account)
+        pipeline.incr(self._version_key(account))
+        pipeline.execute()
+
+    def _version_key(self, account):
+        return f'{self.prefix}{account}:version'
+
+    def lock(self, account):
+        return self.client.lock(f'{self.prefix}{account}:lock', timeout=30, blocking_timeout=30)
+
+def _text(value):
+    return value.decode('utf8') if isinstance(value, bytes) else value
+
+class TokenCacheStore:
+    """Per-account MSAL token caches held in memory and persisted as deltas
+
+    Lookups are served from the in-memory cache, which is checked against
+    the backend's version of the account at most every recheck seconds
+    and re-read when another process has written it since. Only entries
+    that changed since the last save are written to the backend, under a
+    per-account lock. Accounts not loaded for idle_timeout seconds are
+    dropped from memory.
+    """
+
+    def __init__(self, backend, recheck=TOKEN_CACHE_RECHECK, idle_timeout=TOKEN_CACHE_IDLE_TIMEOUT):
+        self.backend = backend
+        self.recheck = recheck
+        self.idle_timeout = idle_timeout
+        # account -> _CachedAccount
+        self._caches = {}
+        self._lock = threading.Lock()
+        self._last_eviction = time.monotonic()
+
+    def load(self, account):
+        # The account's cache, from memory while it was checked against
+        # the backend less than recheck seconds ago. Takes no lock: use
+        # it to read tokens, and locked() to redeem a refresh token.
+        return self._load(account, self.recheck)
+
+    @contextmanager
+    def locked(self, account):
+        # Hold the account's backend lock while the caller uses its cache,
+        # e.g. acquire_token_silent, which may redeem the refresh token,
+        # then save what changed. Other processes doing the same for the
+        # account wait, then see the tokens this one saved.
+        with self.backend.lock(account):
+            cache = self._load(account, 0)
+            yield cache
+            self._save(account, cache)
+
+    def save(self, account, cache):
+        if not cache.has_state_changed:
+            return
+
+        with self.backend.lock(account):
+            self._save(account, cache)
+
+    def remove(self, account):
+        with self.backend.lock(account):
+            self.backend.delete(account)
+            with self._lock:
+                self._caches.pop(account, None)
+
+    def _load(self, account, recheck):
+        # Return the account's cache, re-reading the backend if it has a
+        # newer version and the copy in memory was last checked more than
+        # recheck seconds ago
+        now = time.monotonic()
+        self._evict_idle(now)
+        with self._lock:
+            cached = self._caches.get(account)
+            if cached is not None:
+                cached.used = now
+                if now - cached.checked < recheck:
+                    return cached.cache
+
+        if cached is not None and self.backend.version(account) == cached.version:
+            cached.checked = now
+            return cached.cache
+
+        entries, version = self.backend.read(account)
+        with self._lock:
+            cached = self._caches.get(account)
+            if cached is None:
+                cached = self._caches[account] = _CachedAccount(msal.SerializableTokenCache())
+            elif version == cached.version:
+                # Another thread re-read it meanwhile
+                cached.checked = now
+                return cached.cache
+            # Reuse the cache object so the MSAL client built on it stays valid
+            cached.cache.deserialize(json.dumps(_unflatten(entries)) if entries else None)
+            cached.cache.has_state_changed = False
+            cached.entries = entries
+            cached.version = version
+            cached.checked = cached.used = now
+            return cached.cache
+
+    def _save(self, account, cache):
+        # Write what changed since the last save; hold the account's lock
+        if not cache.has_state_changed:
+            return
+
+        entries = _flatten(json.loads(cache.serialize()))
+        with self._lock:
+            cached = self._caches.get(account)
+            persisted = cached.entries if cached is not None else {}
+
+        changed = {field: data for field, data in entries.items() if persisted.get(field) != data}
+        removed = [field for field in persisted if field not in entries]
+        version = self.backend.write(account, changed, removed) if changed or removed else None
+
+        cache.has_state_changed = False
+        with self._lock:
+            cached = self._caches.get(account)
+            if cached is None:
+                cached = self._caches[account] = _CachedAccount(cache)
+            # A cache adopted at sign-in replaces the one held for the account
+            cached.cache = cache
+            cached.entries = entries
+            if version is not None:
+                cached.version = version
+            cached.checked = cached.used = time.monotonic()
+
+    def _evict_idle(self, now):
+        if now - self._last_eviction < min(self.idle_timeout, 60):
+            return
+        with self._lock:
+            self._last_eviction = now
+            for account in [account for account, cached in self._caches.items()
+                            if now - cached.used > self.idle_timeout]:
+                del self._caches[account]
+
+class _CachedAccount:
+    # One account's cache with the entries and backend version it was
+    # last read or saved at
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.entries = {}
+        self.version = None
+        self.checked = self.used = 0.0
+
+def cached_access_token(cache, account, scopes):
+    # The access token acquire_token_silent would return for the account
+    # (a home_account_id) without redeeming its refresh token, or None
+    # when it is missing, near expiry or past its refresh_on time
+    now = time.time()
+    for entry in cache.find(msal.TokenCache.CredentialType.ACCESS_TOKEN, target=scopes,
+                            query={'home_account_id': account}):
+        if int(entry['expires_on']) - now < ACCESS_TOKEN_EXPIRY_MARGIN:
+            continue
+        if 'refresh_on' in entry and int(entry['refresh_on']) < now:
+            continue
+        return {'access_token': entry['secret'], 'token_type': entry.get('token_type', 'Bearer'),
+                'expires_in': int(int(entry['expires_on']) - now)}
+    return None
+
+def _flatten(serialized):
+    # {'AccessToken': {key: entry}} -> {'AccessToken|key': entry}
+    return {f'{section}|{key}': entry
+            for section, section_entries in serialized.items()
+            for key, entry in section_entries.items()}
+
+def _unflatten(entries):
+    serialized = {}
+    for field, entry in entries.items():
+        section, key = field.split('|', 1)
+        serialized.setdefault(section, {})[key] = entry
+    return serialized
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_token_cache_store():
+    # Return the process-wide token cache store, creating it on first use
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = TokenCacheStore(_create_backend(TOKEN_CACHE_URL))
+    return _store
+
+def _create_backend(url):
+    if url.startswith(('redis://', 'rediss://')):
+        try:
+            import redis
+        except ImportError as exc:
+            raise ImportError('TOKEN_CACHE_URL points at Redis but the redis package is not installed') from exc
+        return RedisTokenCacheBackend(redis.Redis.from_url(url))
+
+    return SQLiteTokenCacheBackend(url)
@@ -0,0 +1,90 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import heapq
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Renew tokens once this fraction of their lifetime has passed, and retry
+# failed renewals after TOKEN_REFRESH_RETRY seconds.
+# Override with the TOKEN_REFRESH_FRACTION environment variable.
+TOKEN_REFRESH_FRACTION = float(os.environ.get('TOKEN_REFRESH_FRACTION', '0.8'))
+TOKEN_REFRESH_RETRY = 60
+
+class TokenRefresher:
+    """Daemon thread that renews tracked tokens ahead of their expiry
+
+    Each tracked key has a refresh callable. The callable is run once
+    TOKEN_REFRESH_FRACTION of the token's lifetime has passed and is
+    expected to call schedule() again with the renewed token's expiry.
+    """
+
+    def __init__(self, fraction=TOKEN_REFRESH_FRACTION):
+        self.fraction = fraction
+        self._due = {}
+        self._heap = []
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, key, issued_at, expires_at, refresh):
+        due = issued_at + self.fraction * (expires_at - issued_at)
+        self._schedule_at(key, due, refresh)
+
+    def _schedule_at(self, key, due, refresh):
+        with self._condition:
+            self._due[key] = (due, refresh)
+            heapq.heappush(self._heap, (due, key))
+            self._start()
+            self._condition.notify()
+
+    def unschedule(self, key):
+        with self._condition:
+            self._due.pop(key, None)
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='token-refresher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                key, refresh = self._next_due()
+
+            try:
+                refresh()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Background token refresh failed for %s', key)
+                self._schedule_at(key, time.time() + TOKEN_REFRESH_RETRY, refresh)
+
+    def _next_due(self):
+        # Wait (holding the condition) until a scheduled refresh is due
+        while True:
+            if not self._heap:
+                self._condition.wait()
+                continue
+
+            due, key = self._heap[0]
+            current = self._due.get(key)
+            if current is None or current[0] != due:
+                # Superseded or unscheduled entry
+                heapq.heappop(self._heap)
+                continue
+
+            delay = due - time.time()
+            if delay > 0:
+                self._condition.wait(delay)
+                continue
+
+            heapq.heappop(self._heap)
+            del self._due[key]
+            return key, current[1]
+
+_refresher = TokenRefresher()
+
+def get_token_refresher():
+    return _refresher
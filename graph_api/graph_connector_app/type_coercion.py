@@ -0,0 +1,194 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import logging
+import re
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+
+import sqlalchemy as sa
+
+logger = logging.getLogger(__name__)
+
+# Day zero of Excel's 1900 date system, allowing for its phantom 29 Feb 1900
+EXCEL_EPOCH = date(1899, 12, 30)
+
+# Text date layouts seen in district exports
+DATE_FORMATS = ('%m/%d/%Y', '%Y-%m-%d', '%m/%d/%y', '%Y-%m-%dT%H:%M:%S', '%m/%d/%Y %H:%M')
+
+class TableCoercer:
+    """Turn worksheet windows into insert-ready rows for one staging table
+
+    Column types come from the SQLAlchemy table. The first prefix_width
+    table columns are filled from the prefix values (district, subject,
+    ...); the rest are matched to worksheet columns by header name, so a
+    reordered or extended export still lands in the right columns. Until
+    a file's header row is seen its columns are taken in table order.
+
+    Worksheet headers that match no table column are skipped, and table
+    columns no header matches load as NULL; coerce reports both, once
+    per file, and they are logged.
+    """
+
+    def __init__(self, table, prefix_width):
+        self.table = table
+        self.prefix_width = prefix_width
+        self.columns = list(table.columns)
+        self.kinds = [_kind_of(column.type) for column in self.columns]
+        self.names = {_normalize(column.name): index for index, column in enumerate(self.columns)}
+        keys = [column for column in self.columns if column.primary_key] or self.columns[prefix_width:prefix_width + 1]
+        self.key_index = self.columns.index(keys[0])
+        # file id -> (table column -> worksheet column, key header text)
+        self._layouts = {}
+        # table column -> worksheet column -> converter
+        self._converters = {}
+
+    def coerce(self, file, prefix, window):
+        # Return (rows, header_rows_dropped, unmatched) for one window of
+        # a file. unmatched is (worksheet headers matching no table
+        # column, table columns left NULL) on the window holding the
+        # file's header row, else None. Windows of a file must arrive in
+        # sheet order.
+        layout = self._layouts.get(file['id'])
+        dropped = 0
+        unmatched = None
+        if layout is None:
+            layout = self._header_layout(window[0]) if window else None
+            if layout is not None:
+                unmatched = self._unmatched(file, window[0], layout[0])
+                window = window[1:]
+                dropped += 1
+            else:
+                layout = self._positional_layout(), None
+                if window:
+                    logger.warning('%s: no %s header row found, columns taken in table order',
+                                   file.get('FileName', file['id']), self.table.name)
+            self._layouts[file['id']] = layout
+
+        sources, key_text = layout
+        width = len(window[0]) if window else 0
+        # Worksheet columns past the window's width (a narrower sheet) load as NULL
+        sources = tuple(source if source is not None and source < width else None for source in sources)
+
+        converter = self._converters.get(sources)
+        if converter is None:
+            converter = self._converters[sources] = _build_converter(sources, self.kinds, self.prefix_width)
+
+        # Repeated header rows further down the sheet are skipped
+        key_position = sources[self.key_index] if key_text is not None else None
+        if key_position is None:
+            rows = converter(window, prefix, None, 0)
+        else:
+            rows = converter(window, prefix, key_text, key_position)
+            dropped += len(window) - len(rows)
+        return rows, dropped, unmatched
+
+    def _unmatched(self, file, header, sources):
+        used = set(sources)
+        ignored = [str(value) for position, value in enumerate(header)
+                   if position not in used and value not in ('', None)]
+        missing = [column.name for column, source in zip(self.columns[self.prefix_width:],
+                                                         sources[self.prefix_width:]) if source is None]
+        if ignored or missing:
+            logger.warning('%s: %s headers not in %s: %s; columns with no header, loaded as NULL: %s',
+                           file.get('FileName', file['id']), len(ignored), self.table.name,
+                           ignored, missing)
+        return ignored, missing
+
+    def _positional_layout(self):
+        return [None] * self.prefix_width + list(range(len(self.columns) - self.prefix_width))
+
+    def _header_layout(self, row):
+        # Treat the row as a header if it names at least half of the
+        # worksheet-fed columns, including the key column
+        positions = {}
+        for position, value in enumerate(row):
+            if isinstance(value, str):
+                index = self.names.get(_normalize(value))
+                if index is not None and index >= self.prefix_width:
+                    positions.setdefault(index, position)
+
+        if self.key_index not in positions or len(positions) * 2 < len(self.columns) - self.prefix_width:
+            return None
+
+        sources = [positions.get(index) for index in range(len(self.columns))]
+        return sources, row[positions[self.key_index]]
+
+def _normalize(name):
+    # 'Reading Comprehension: Overall Scale Score' -> 'readingcomprehensionoverallscalescore'
+    return re.sub(r'[^0-9a-z]', '', name.lower())
+
+def _kind_of(column_type):
+    if isinstance(column_type, sa.Integer):
+        return 'integer'
+    if isinstance(column_type, sa.Numeric):
+        return 'numeric'
+    if isinstance(column_type, sa.Date) and not isinstance(column_type, sa.DateTime):
+        return 'date'
+    return 'string'
+
+def _to_string(value):
+    return '' if value is None else str(value)
+
+def _to_integer(value):
+    # Excel TRUE/FALSE cells come through as bool, which int columns
+    # would otherwise reject as not exactly int
+    if value.__class__ is bool:
+        return int(value)
+    if value.__class__ is float:
+        return round(value)
+    if value.__class__ is str and value:
+        number = _to_numeric(value)
+        return round(number) if number is not None else None
+    return None
+
+def _to_numeric(value):
+    if value.__class__ is str and value:
+        try:
+            number = Decimal(value.replace(',', '').strip().rstrip('%'))
+        except InvalidOperation:
+            return None
+        return number if number.is_finite() else None
+    return None
+
+@lru_cache(maxsize=8192)
+def _to_date(value):
+    # Excel serial numbers and text dates; a column repeats the same few
+    # dates, so conversions are cached
+    if value.__class__ in (int, float) and value > 0:
+        return EXCEL_EPOCH + timedelta(days=int(value))
+    if value.__class__ is str and value:
+        text = value.strip()
+        for date_format in DATE_FORMATS:
+            try:
+                return datetime.strptime(text, date_format).date()
+            except ValueError:
+                continue
+    return None
+
+# Per column kind: the cell classes already of the right type, and the
+# converter for anything else
+_KINDS = {
+    'string': ((str,), _to_string),
+    'integer': ((int,), _to_integer),
+    'numeric': ((int, float), _to_numeric),
+    'date': ((), _to_date),
+}
+
+def _build_converter(sources, kinds, prefix_width):
+    # Build convert(window, prefix, key_text, key_position) returning the
+    # window's rows as tuples in table column order. The prefix fills the
+    # leading columns; columns with no worksheet source load as NULL.
+    cells = [(source,) + _KINDS[kind] for source, kind in zip(sources[prefix_width:], kinds[prefix_width:])]
+
+    def convert(window, prefix, key_text, key_position):
+        head = list(prefix[:prefix_width])
+        return [tuple(head + [None if source is None
+                              else value if (value := row[source]).__class__ in typed
+                              else to_kind(value)
+                              for source, typed, to_kind in cells])
+                for row in window
+                if key_text is None or row[key_position] != key_text]
+
+    return convert
@@ -1,24 +1,37 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import os
+
 from django.urls import path
 
 from . import views
 
+# Under ASGI the Graph-bound pages use their async versions (see asgi.py).
+# They need httpx, so they are only imported when asked for.
+if os.environ.get('GRAPH_ASYNC_VIEWS') == '1':
+    from . import async_views as graph_views
+else:
+    graph_views = views
+
 urlpatterns = [
   # /
   path('', views.home, name='home'),
   path('signin', views.sign_in, name='signin'),
   path('signout', views.sign_out, name='signout'),
-  path('calendar', views.calendar, name='calendar'),
+  path('calendar', graph_views.calendar, name='calendar'),
   path('callback', views.callback, name='callback'),
   path('calendar/new', views.new_event, name='newevent'),
-  path('ai_files', views.ai_files, name='ai_files'),
-  path('file_data/<str:file_id>/<str:worksheet_name>', views.file_data, name = 'file_data'),
+  path('ai_files', graph_views.ai_files, name='ai_files'),
+  path('file_data/<str:file_id>/<str:worksheet_name>', graph_views.file_data, name = 'file_data'),
   path('get_all_reading_iready', views.get_all_reading_iready, name='get_all_reading_iready'),
   path('get_all_math_iready', views.get_all_math_iready, name='get_all_math_iready'),
   path('get_all_eligibility', views.get_all_eligibility, name='get_all_eligibility'),
-  path('get_picker', views.get_picker, name='get_years'),
+  path('get_all_datasets', views.get_all_datasets, name='get_all_datasets'),
+  path('bulk_ingest_years', views.bulk_ingest_years, name='bulk_ingest_years'),
+  path('get_picker', graph_views.get_picker, name='get_years'),
   path('load_tables', views.load_tables, name='load_tables'),
-  path('get_districts', views.get_districts, name='get_districts')
+  path('get_districts', graph_views.get_districts, name='get_districts'),
+  path('refresh_listings', views.refresh_listings, name='refresh_listings'),
+  path('jobs/<int:job_id>', views.job_status, name='job_status')
 ]
@@ -10,10 +10,15 @@ from django.urls import reverse
 from graph_connector_app.auth_helper import (get_sign_in_flow, get_token,
                                   get_token_from_code, get_token_for_app,
                                   remove_user_and_token, store_user)
+from graph_connector_app.bulk_ingest import bulk_ingest
+from graph_connector_app.datasets import ingest_datasets
+from graph_connector_app.drive_sync import get_drive_mirror
 from graph_connector_app.graph_helper import (create_event, get_calendar_events,
-                                   get_file_data, get_filelist,
-                                   get_iana_from_windows, get_user,
-                                   get_worksheets)
+                                   get_file_data, get_iana_from_windows,
+                                   get_user, resolve_worksheet_names)
+from graph_connector_app.jobs import start_job_monitor, submit_job
+from graph_connector_app.listing_cache import get_listing_cache
+from graph_connector_app.models import IngestJob
 from graph_connector_app.sqlalchemy_models import sql_models as sm
 
 #SET DRIVE AND DIRECTORY LIST
@@ -33,6 +38,10 @@ drive = '/drives/b!j7GCe-Two0-73phJMu9XqviV7CunZMpEm0xZVyOP271WIaR6JXsIQKeBR7P0r
 """            
 directory_list = ['root:/IT Solutions/2024-2025 Data/New York:/children']
 
+#YEAR FOLDERS ONLY CHANGE ONCE A YEAR, SO KEEP THAT LISTING FOR 10 MINUTES
+ai_root_directory = 'root:/IT Solutions:/children'
+get_listing_cache().set_ttl(ai_root_directory, 600)
+
 #runs on https://localhost:8000
 
 
@@ -88,6 +97,28 @@ def calendar(request):
     if not user['is_authenticated']:
         return HttpResponseRedirect(reverse('signin'))
 
+    start, end = _calendar_week(user)
+
+    token = get_token(request)
+
+    events = []
+    for event in get_calendar_events(
+        token,
+        start.isoformat(timespec='seconds'),
+        end.isoformat(timespec='seconds'),
+        user['timeZone']):
+        # Convert the ISO 8601 date times to a datetime object
+        # This allows the Django template to format the value nicely
+        event['start']['dateTime'] = parser.parse(event['start']['dateTime'])
+        event['end']['dateTime'] = parser.parse(event['end']['dateTime'])
+        events.append(event)
+
+    if events:
+        context['events'] = events
+
+    return render(request, 'graph_connector_app/calendar.html', context)
+
+def _calendar_week(user):
     # Load the user's time zone
     # Microsoft Graph can return the user's time zone as either
     # a Windows time zone name or an IANA time zone identifier
@@ -110,24 +141,7 @@ def calendar(request):
 
     end = start + timedelta(days=7)
 
-    token = get_token(request)
-
-    events = get_calendar_events(
-        token,
-        start.isoformat(timespec='seconds'),
-        end.isoformat(timespec='seconds'),
-        user['timeZone'])
-
-    if events:
-        # Convert the ISO 8601 date times to a datetime object
-        # This allows the Django template to format the value nicely
-        for event in events['value']:
-            event['start']['dateTime'] = parser.parse(event['start']['dateTime'])
-            event['end']['dateTime'] = parser.parse(event['end']['dateTime'])
-
-        context['events'] = events['value']
-
-    return render(request, 'graph_connector_app/calendar.html', context)
+    return start, end
 
 def get_picker(request):
     context = initialize_context(request)
@@ -135,47 +149,47 @@ def get_picker(request):
 
     #SET THE DRIVE AND DIRECTORY FOLDERS THAT WE WILL NEED
 
-    #token = get_token(request)
-    token = get_token_for_app(request)
-
-    directory_list = ['root:/IT Solutions:/children']
-
-
-    for directory in directory_list:
-        years = get_filelist(token,drive,directory)
-
-        if years:
-            for index, year in enumerate(years['value']):
-                created_date = parser.parse(year['createdDateTime'])
-                year['createdDateTime'] = created_date.strftime('%Y-%m-%d %H:%M:%S')
-                year['ParentDirectory'] = year['parentReference']['path'].rsplit('/', 1)[-1]
-                year['AcademicYear'] = year['name']
-                #RWR 2025-01-28 REMOVE LIOTA FOLDER:
-                if year['name'] == 'LIOTA':
-                    years['value'].pop(index)
-            if 'ai_years' in context:
-                for new_year in years['value']:
-                    context['ai_years'].append(new_year)
-            else:
-                context['ai_years'] = years['value']
+    context['ai_years'] = get_listing_cache().get(ai_root_directory,
+                                                  lambda: _list_years(ai_root_directory))
 
     return render(request, 'graph_connector_app/ai_folderpicker.html', context)
 
+def _list_years(directory):
+    #token = get_token(request)
+    years = []
+    for year in get_drive_mirror(drive, get_token_for_app).list_children(directory):
+        #RWR 2025-01-28 REMOVE LIOTA FOLDER:
+        if year['name'] == 'LIOTA':
+            continue
+        created_date = parser.parse(year['createdDateTime'])
+        year['createdDateTime'] = created_date.strftime('%Y-%m-%d %H:%M:%S')
+        year['ParentDirectory'] = year['parentReference']['path'].rsplit('/', 1)[-1]
+        year['AcademicYear'] = year['name']
+        years.append(year)
+    return years
+
+def refresh_listings(request):
+    # Drop cached folder listings and have the mirror pull pending drive
+    # changes now; listings are dropped again if the sync changes anything
+    get_listing_cache().invalidate()
+    get_drive_mirror(drive, get_token_for_app).sync_soon()
+
+    return HttpResponseRedirect(reverse('get_years'))
+
 def get_districts(request):
     #context = initialize_context(request)
 
     ai_year = request.GET.get('ai_year_selection')
 
-    directory = 'root:/IT Solutions/' + ai_year + ':/children'
-
-    token = get_token_for_app(request)
+    # Only folders listed on the year picker, so a request can't make the
+    # listing cache hold arbitrary paths
+    years = get_listing_cache().get(ai_root_directory, lambda: _list_years(ai_root_directory))
+    if ai_year not in {year['name'] for year in years}:
+        return JsonResponse({'error': 'No such academic year'}, status=404)
 
-    file_data = get_filelist(token,drive,directory)
+    directory = 'root:/IT Solutions/' + ai_year + ':/children'
 
-    district_list = []
-    
-    for index, district in enumerate(file_data['value']):
-        district_list.append(district['name'])
+    district_list = get_listing_cache().get(directory, lambda: _list_districts(directory))
 
     response_data = {
         "districts" : district_list
@@ -185,6 +199,9 @@ def get_districts(request):
 
 
 
+def _list_districts(directory):
+    return [district['name'] for district in get_drive_mirror(drive, get_token_for_app).list_children(directory)]
+
 def ai_files(request):
     context = initialize_context(request)
     #user = context['user']
@@ -193,35 +210,36 @@ def ai_files(request):
 
     #SET THE DRIVE AND DIRECTORY FOLDERS THAT WE WILL NEED
 
-    #token = get_token(request)
-    token = get_token_for_app(request)
-
     directory_list = []
     directory_list.append('root:/IT Solutions/' + request.POST.get('year') + '/' + request.POST.get('district') + ':/children')
 
     for directory in directory_list:
-        files = get_filelist(token,drive,directory)
-
+        files = _list_files(directory)
         if files:
-            for file in files['value']:
-                created_date = parser.parse(file['createdDateTime'])
-                modified_date = parser.parse(file['lastModifiedDateTime'])
-                file['createdDateTime'] = created_date.strftime('%Y-%m-%d %H:%M')
-                file['lastModifiedDateTime'] = modified_date.strftime('%Y-%m-%d %H:%M')
-                file['ParentDirectory'] = file['parentReference']['path'].rsplit('/', 1)[-1]
-                file['AcademicYear'] = file['parentReference']['path'].rsplit('/', 2)[-2][:9]
-                worksheet_data = get_worksheets(token,drive,file['id'])
-                file['WorksheetName'] = worksheet_data['WorksheetName']
-            if 'ai_files' in context:
-                for new_file in files['value']:
-                    context['ai_files'].append(new_file)
-            else:
-                context['ai_files'] = files['value']
+            context.setdefault('ai_files', []).extend(files)
 
     context['ai_directory_path'] = directory_list[0]
 
     return render(request, 'graph_connector_app/ai_files.html', context)
 
+def _list_files(directory):
+    #token = get_token(request)
+    token = get_token_for_app()
+
+    files = []
+    for file in get_drive_mirror(drive, get_token_for_app).list_children(directory):
+        created_date = parser.parse(file['createdDateTime'])
+        modified_date = parser.parse(file['lastModifiedDateTime'])
+        file['createdDateTime'] = created_date.strftime('%Y-%m-%d %H:%M')
+        file['lastModifiedDateTime'] = modified_date.strftime('%Y-%m-%d %H:%M')
+        file['ParentDirectory'] = file['parentReference']['path'].rsplit('/', 1)[-1]
+        file['AcademicYear'] = file['parentReference']['path'].rsplit('/', 2)[-2][:9]
+        files.append(file)
+
+    if files:
+        resolve_worksheet_names(token,drive,files)
+    return files
+
 def file_data(request, file_id, worksheet_name):
     context = initialize_context(request)
 
@@ -232,284 +250,79 @@ def file_data(request, file_id, worksheet_name):
 
     return render(request, 'graph_connector_app/file_data.html', context)
 
-def get_all_math_iready(request):
+def _ingest(progress, directory_path, datasets=None):
+    # Jobs can outlast a token, so the pipeline asks for one as it goes
+    return ingest_datasets(get_token_for_app,drive,directory_path,datasets,progress.report)
+
+def _bulk_ingest(progress, years):
+    return bulk_ingest(drive,years,progress=progress.report)
+
+def bulk_ingest_years(request):
     context = initialize_context(request)
 
-    token = get_token_for_app(request)
-    directory_list = []
-    file_info_list = []
-    file_dict = {}
+    # Every district of the selected academic years, across worker processes
+    context['job'] = submit_job('bulk_ingest', _bulk_ingest,
+                                years=request.POST.getlist('years'))
 
-    directory_list.append(request.POST.get('directory_path'))
+    return render(request, 'graph_connector_app/job.html', context)
 
-    for directory in directory_list:
-        files = get_filelist(token,drive,directory)
+def get_all_datasets(request):
+    context = initialize_context(request)
 
-        if files:
-            for file in files['value']:
-                file_dict['FileName'] = file['name']
-                file_dict['id'] = file['id']
-                created_date = parser.parse(file['createdDateTime'])
-                file['createdDateTime'] = created_date.strftime('%Y-%m-%d %H:%M:%S')
-                file_dict['createdDateTime'] = created_date.strftime('%Y-%m-%d %H:%M:%S')
-                file['ParentDirectory'] = file['parentReference']['path'].rsplit('/', 1)[-1]
-                file_dict['ParentDirectory'] = file['parentReference']['path'].rsplit('/', 1)[-1]
-                file['AcademicYear'] = file['parentReference']['path'].rsplit('/', 2)[-2][:9]
-                file_dict['AcademicYear'] = file['parentReference']['path'].rsplit('/', 2)[-2][:9]                
-                worksheet_data = get_worksheets(token,drive,file['id'])
-                file['WorksheetName'] = worksheet_data['WorksheetName']
-                file_dict['WorksheetName'] = worksheet_data['WorksheetName']
-
-                if '_math' in file_dict['FileName'].lower():
-                    file_info_list.append(file_dict.copy())
-
-    file_data_tab =[]
-    for file in file_info_list:
-        if 'file_data' not in context:
-            file_data_tab = get_file_data(token,drive,file['id'],file['WorksheetName'])['values']
-            for row in file_data_tab:
-                row.insert(0, 'Math iReady')
-                row.insert(0, file['ParentDirectory'])
-            context['file_data'] = file_data_tab
-        else:
-            file_data_tab = get_file_data(token,drive,file['id'],file['WorksheetName'])['values']
-            for row in file_data_tab:
-                row.insert(0, 'Math iReady')
-                row.insert(0, file['ParentDirectory'])
-            context['file_data'] += file_data_tab
-    for idx, record in enumerate (context['file_data']):
-        if not isinstance(record[5], str): #StudentGrade
-            record[5] = str(record[5])
-        if isinstance(record[24], str): #StartDate
-            record[24] = None        
-        if isinstance(record[25], str): #CompletionDate
-            record[25] = None        
-        if isinstance(record[29], str): #Duration(min)
-            record[29] = None        
-        if isinstance(record[32], str): #OverallScaleScore
-            record[32] = None        
-        if isinstance(record[35], str): #Percentile
-            record[35] = None        
-        if isinstance(record[36], str): #Grouping
-            record[36] = None        
-        if isinstance(record[39], str): #NumberandOperationsScaleScore
-            record[39] = None        
-        if isinstance(record[42], str): #AlgebraandAlgebraicThinkingScaleScore
-            record[42] = None        
-        if isinstance(record[45], str): #MeasurementandDataScaleScore
-            record[45] = None        
-        if isinstance(record[48], str): #GeometryScaleScore
-            record[48] = None
-        if isinstance(record[51], str): #DiagnosticGain
-            record[51] = None
-        if isinstance(record[52], str): #AnnualTypicalGrowthMeasure
-            record[52] = None
-        if isinstance(record[53], str): #AnnualStretchGrowthMeasure
-            record[53] = None
-        if isinstance(record[54], str): #[PercentProgresstoAnnualTypicalGrowth(%)]
-            record[54] = None
-        if isinstance(record[55], str): #[PercentProgresstoAnnualStretchGrowth(%)]
-            record[55] = None
-        if isinstance(record[56], str): #[MidOnGradeLevelScaleScore]
-            record[56] = None
-    for idx, record in enumerate (context['file_data']):
-        if record[4] == 'Student ID':
-            context['file_data'].pop(idx)
-
-    db = sm.db
-
-    trans = db.connection.begin()
-    db.connection.execute("TRUNCATE TABLE AI.MathIreadyStaging")
-    trans.commit()
-
-    #for row in context['file_data']:
-    for row in context['file_data']:
-        db.connection.execute(sm.MathiReady.__table__.insert().values(row))
-
-    #lp = sm.LoadProduction()
-    #lp.load_production_tables()
+    # Math, Reading and Eligibility from one listing of the folder
+    context['job'] = submit_job('all_datasets', _ingest,
+                                directory_path=request.POST.get('directory_path'))
 
-    return render(request, 'graph_connector_app/file_data.html', context)
+    return render(request, 'graph_connector_app/job.html', context)
 
-def get_all_reading_iready(request):
+def get_all_math_iready(request):
     context = initialize_context(request)
 
-    token = get_token_for_app(request)
-    directory_list = []
-    file_info_list = []
-    file_dict = {}
+    context['job'] = submit_job('math_iready', _ingest,
+                                directory_path=request.POST.get('directory_path'),
+                                datasets=['math_iready'])
 
-    directory_list.append(request.POST.get('directory_path'))
+    return render(request, 'graph_connector_app/job.html', context)
 
-    for directory in directory_list:
-        files = get_filelist(token,drive,directory)
+def get_all_reading_iready(request):
+    context = initialize_context(request)
 
-        if files:
-            for file in files['value']:
-                file_dict['FileName'] = file['name']
-                file_dict['id'] = file['id']
-                created_date = parser.parse(file['createdDateTime'])
-                file['createdDateTime'] = created_date.strftime('%Y-%m-%d %H:%M:%S')
-                file_dict['createdDateTime'] = created_date.strftime('%Y-%m-%d %H:%M:%S')
-                file['ParentDirectory'] = file['parentReference']['path'].rsplit('/', 1)[-1]
-                file_dict['ParentDirectory'] = file['parentReference']['path'].rsplit('/', 1)[-1]
-                file['AcademicYear'] = file['parentReference']['path'].rsplit('/', 2)[-2][:9]
-                file_dict['AcademicYear'] = file['parentReference']['path'].rsplit('/', 2)[-2][:9]
-                worksheet_data = get_worksheets(token,drive,file['id'])
-                file['WorksheetName'] = worksheet_data['WorksheetName']
-                file_dict['WorksheetName'] = worksheet_data['WorksheetName']
-
-                if '_ela' in file_dict['FileName'].lower():
-                    file_info_list.append(file_dict.copy())
-
-    file_data_tab =[]
-    for file in file_info_list:
-        if 'file_data' not in context:
-            file_data_tab = get_file_data(token,drive,file['id'],file['WorksheetName'])['values']
-            for row in file_data_tab:
-                row.insert(0, 'ELA iReady')
-                row.insert(0, file['ParentDirectory'])
-            context['file_data'] = file_data_tab
-        else:
-            file_data_tab = get_file_data(token,drive,file['id'],file['WorksheetName'])['values']
-            for row in file_data_tab:
-                row.insert(0, 'ELA iReady')
-                row.insert(0, file['ParentDirectory'])
-            context['file_data'] += file_data_tab
-    for idx, record in enumerate (context['file_data']):
-        if not isinstance(record[5], str): #StudentGrade
-            record[5] = str(record[5])
-        if isinstance(record[29], str): #Duration(min)
-            record[29] = None
-        if isinstance(record[32], str): #OverallScaleScore
-            record[32] = None    
-        if isinstance(record[35], str): #Percentile
-            record[35] = None    
-        if isinstance(record[36], str): #Grouping
-            record[36] = None    
-        if isinstance(record[39], str): #PhonologicalAwarenessScaleScore
-            record[39] = None    
-        if isinstance(record[42], str): #PhonicsScaleScore
-            record[42] = None    
-        if isinstance(record[45], str): #High-FrequencyWordsScaleScore
-            record[45] = None    
-        if isinstance(record[48], str): #VocabularyScaleScore
-            record[48] = None    
-        if isinstance(record[51], str): #ReadingComprehension:OverallScaleScore
-            record[51] = None    
-        if isinstance(record[54], str): #ReadingComprehension:LiteratureScaleScore
-            record[54] = None    
-        if isinstance(record[57], str): #ReadingComprehension:InformationalTextScaleScore
-            record[57] = None    
-        if isinstance(record[60], str): #DiagnosticGain
-            record[60] = None
-        if isinstance(record[63], str): #[PercentProgresstoAnnualTypicalGrowth(%)]
-            record[63] = None
-        if isinstance(record[64], str): #[PercentProgresstoAnnualStretchGrowth(%)]
-            record[64] = None
-        if isinstance(record[65], str): #MidOnGradeLevelScaleScore
-            record[65] = None    
-
-    for idx, record in reversed (list (enumerate (context['file_data']))):
-        if record[4] == 'Student ID':
-            context['file_data'].pop(idx)            
-
-    db = sm.db
-
-    trans = db.connection.begin()
-    db.connection.execute("TRUNCATE TABLE AI.ReadingIreadyStaging")
-    trans.commit()
-
-
-    #for row in context['file_data']:
-    for row in context['file_data']:
-        db.connection.execute(sm.ReadingiReady.__table__.insert().values(row))
-
-    #lp = sm.LoadProduction()
-    #lp.load_production_tables()
+    context['job'] = submit_job('reading_iready', _ingest,
+                                directory_path=request.POST.get('directory_path'),
+                                datasets=['reading_iready'])
 
-    return render(request, 'graph_connector_app/file_data.html', context)
+    return render(request, 'graph_connector_app/job.html', context)
 
 def get_all_eligibility(request):
     context = initialize_context(request)
 
-    token = get_token_for_app(request)
-    directory_list = []
-    file_info_list = []
-    file_dict = {}
-
-    directory_list.append(request.POST.get('directory_path'))
+    context['job'] = submit_job('eligibility', _ingest,
+                                directory_path=request.POST.get('directory_path'),
+                                datasets=['eligibility'])
 
-    for directory in directory_list:
-        files = get_filelist(token,drive,directory)
+    return render(request, 'graph_connector_app/job.html', context)
 
-        if files:
-            for file in files['value']:
-                file_dict['FileName'] = file['name']
-                file_dict['id'] = file['id']
-                created_date = parser.parse(file['createdDateTime'])
-                file['createdDateTime'] = created_date.strftime('%Y-%m-%d %H:%M:%S')
-                file_dict['createdDateTime'] = created_date.strftime('%Y-%m-%d %H:%M:%S')
-                file['ParentDirectory'] = file['parentReference']['path'].rsplit('/', 1)[-1]
-                file_dict['ParentDirectory'] = file['parentReference']['path'].rsplit('/', 1)[-1]
-                file['AcademicYear'] = file['parentReference']['path'].rsplit('/', 2)[-2][:9]
-                file_dict['AcademicYear'] = file['parentReference']['path'].rsplit('/', 2)[-2][:9]
-                worksheet_data = get_worksheets(token,drive,file['id'])
-                file['WorksheetName'] = worksheet_data['WorksheetName']
-                file_dict['WorksheetName'] = worksheet_data['WorksheetName']
-
-                if 'eligibility' in file_dict['FileName'].lower():
-                    file_info_list.append(file_dict.copy())
-
-    file_data_tab =[]
-    for file in file_info_list:
-        if 'file_data' not in context:
-            file_data_tab = get_file_data(token,drive,file['id'],file['WorksheetName'])['values']
-            for row in file_data_tab:
-                row.insert(0, file['AcademicYear'])
-                row.insert(0, 'Eligibility')
-                row.insert(0, file['ParentDirectory'])
-            context['file_data'] = file_data_tab
-        else:
-            file_data_tab = get_file_data(token,drive,file['id'],file['WorksheetName'])['values']
-            for row in file_data_tab:
-                row.insert(0, file['AcademicYear'])
-                row.insert(0, 'Eligibility')
-                row.insert(0, file['ParentDirectory'])
-            context['file_data'] += file_data_tab
-    for idx, record in enumerate (context['file_data']):
-        if not isinstance(record[7], str): #StudentGrade
-            record[7] = str(record[7])
-    for idx, record in reversed (list (enumerate (context['file_data']))):
-        if record[3] == 'School Name':
-            context['file_data'].pop(idx)
-    for idx, record in reversed (list (enumerate (context['file_data']))):    
-        if record[6] == '':
-            context['file_data'].pop(idx)
-
-
-    db = sm.db
-
-    trans = db.connection.begin()
-    db.connection.execute("TRUNCATE TABLE AI.EligibilityStaging")
-    trans.commit() 
-
-    #for row in context['file_data']:
-    for row in context['file_data']:
-        db.connection.execute(sm.Eligibility.__table__.insert().values(row))
-
- 
-    return render(request, 'graph_connector_app/file_data.html', context)
+def _load_production(progress):
+    lp = sm.LoadProduction()
+    lp.load_production_tables()
 
 def load_tables(request):
 
     context = initialize_context(request)
-    db = sm.db
 
-    lp = sm.LoadProduction()
-    lp.load_production_tables()
+    context['job'] = submit_job('load_production', _load_production)
+
+    return render(request, 'graph_connector_app/job.html',context)
+
+def job_status(request, job_id):
+    # A restarted worker fails the jobs its predecessor left behind
+    start_job_monitor()
+    try:
+        job = IngestJob.objects.get(pk=job_id)
+    except IngestJob.DoesNotExist:
+        return JsonResponse({'error': 'No such job'}, status=404)
 
-    return render(request, 'graph_connector_app/home.html',context)
+    return JsonResponse(job.as_dict())
 
 def new_event(request):
     context = initialize_context(request)
@@ -0,0 +1,123 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+# Location and size limit of the worksheet cache.
+# Override with the WORKSHEET_CACHE_PATH and WORKSHEET_CACHE_MAX_BYTES
+# environment variables.
+WORKSHEET_CACHE_PATH = os.environ.get('WORKSHEET_CACHE_PATH', 'worksheet_cache.sqlite3')
+WORKSHEET_CACHE_MAX_BYTES = int(os.environ.get('WORKSHEET_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+
+class WorksheetCache:
+    """Worksheet values keyed by drive item id and cTag/eTag, evicted least recently used first"""
+
+    def __init__(self, path=WORKSHEET_CACHE_PATH, max_bytes=WORKSHEET_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS worksheet_cache (
+                    item_id TEXT PRIMARY KEY,
+                    tag TEXT NOT NULL,
+                    worksheet_name TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL,
+                    data BLOB NOT NULL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_worksheet_cache_last_used ON worksheet_cache (last_used)")
+
+    @contextmanager
+    def _connect(self):
+        # A connection per call keeps the cache safe across threads and
+        # gunicorn workers; SQLite serialises the writers
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, item_id, tag, worksheet_name):
+        # Return the cached values if the item has not changed, else None
+        if not tag:
+            return None
+
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT data FROM worksheet_cache WHERE item_id = ? AND tag = ? AND worksheet_name = ?",
+                (item_id, tag, worksheet_name)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE worksheet_cache SET last_used = ? WHERE item_id = ?",
+                (time.time(), item_id))
+
+        return json.loads(zlib.decompress(row[0]))
+
+    def get_worksheet_name(self, item_id, tag):
+        # Return the cached worksheet name if the item has not changed, else None
+        if not tag:
+            return None
+
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT worksheet_name FROM worksheet_cache WHERE item_id = ? AND tag = ?",
+                (item_id, tag)).fetchone()
+
+        return row[0] if row else None
+
+    def put(self, item_id, tag, worksheet_name, values):
+        # Store the values for this version of the item, replacing any
+        # older version, then evict until the cache fits max_bytes
+        if not tag:
+            return
+
+        data = zlib.compress(json.dumps(values).encode('utf8'))
+        if len(data) > self.max_bytes:
+            return
+
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO worksheet_cache (item_id, tag, worksheet_name, size, last_used, data) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (item_id, tag, worksheet_name, len(data), time.time(), data))
+            self._evict(conn)
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM worksheet_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        for item_id, size in conn.execute(
+                "SELECT item_id, size FROM worksheet_cache ORDER BY last_used").fetchall():
+            conn.execute("DELETE FROM worksheet_cache WHERE item_id = ?", (item_id,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def invalidate(self, item_id=None):
+        # Drop one item, or everything when item_id is None
+        with self._connect() as conn:
+            if item_id is None:
+                conn.execute("DELETE FROM worksheet_cache")
+            else:
+                conn.execute("DELETE FROM worksheet_cache WHERE item_id = ?", (item_id,))
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_worksheet_cache():
+    # Return the process-wide worksheet cache, creating it on first use
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = WorksheetCache()
+    return _cache
@@ -0,0 +1,156 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import io
+import posixpath
+import zipfile
+from xml.etree.ElementTree import iterparse
+
+# SpreadsheetML and relationship namespaces used inside an xlsx package
+MAIN_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+PACKAGE_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+# Column letters already converted to numbers
+_COLUMNS = {}
+
+def read_worksheet_values(content, worksheet_name=None):
+    # Parse one worksheet of an xlsx file into the same row lists the
+    # workbook usedRange API returns: a rectangular list of rows with
+    # blank cells as '' and raw cell values (dates stay Excel serial
+    # numbers, as they do in usedRange).
+    # Uses the named worksheet if it exists, otherwise the first one.
+    # The sheet XML is streamed, so only the parsed values are held.
+    with zipfile.ZipFile(io.BytesIO(content)) as package:
+        shared_strings = _read_shared_strings(package)
+        sheet_path = _find_sheet_path(package, worksheet_name)
+
+        rows = {}
+        row_number = 0
+        # The row's cells as (column, value), placed once the row ends and
+        # its number is known
+        cells = []
+        cell_row = None
+        column_number = 0
+        cell_tag = f'{MAIN_NS}c'
+        row_tag = f'{MAIN_NS}row'
+        with package.open(sheet_path) as sheet:
+            for _, element in iterparse(sheet):
+                if element.tag == cell_tag:
+                    reference = element.get('r')
+                    if reference:
+                        column_number, cell_row = _cell_position(reference)
+                    else:
+                        # Without a reference the cell follows on from the previous one
+                        column_number += 1
+                    value = _cell_value(element, shared_strings)
+                    if value != '':
+                        cells.append((column_number, value))
+                    element.clear()
+                elif element.tag == row_tag:
+                    # Rows may skip numbers; one without r follows the previous row
+                    reference = element.get('r')
+                    if reference:
+                        row_number = int(reference)
+                    else:
+                        row_number = cell_row if cell_row is not None else row_number + 1
+                    if cells:
+                        values = rows[row_number] = [''] * max(column for column, _ in cells)
+                        for column, value in cells:
+                            values[column - 1] = value
+                        cells = []
+                    cell_row = None
+                    column_number = 0
+                    element.clear()
+
+    if not rows:
+        return []
+
+    # Trim to the used range: the span of rows and columns holding values
+    min_row = min(rows)
+    max_row = max(rows)
+    max_col = max(len(values) for values in rows.values())
+    min_col = min(next(index for index, value in enumerate(values) if value != '')
+                  for values in rows.values())
+
+    width = max_col - min_col
+    used_range = []
+    for row in range(min_row, max_row + 1):
+        values = rows.pop(row, [])[min_col:]
+        used_range.append(values + [''] * (width - len(values)))
+    return used_range
+
+def _read_shared_strings(package):
+    if 'xl/sharedStrings.xml' not in package.namelist():
+        return []
+
+    strings = []
+    with package.open('xl/sharedStrings.xml') as shared:
+        for _, element in iterparse(shared):
+            if element.tag == f'{MAIN_NS}si':
+                strings.append(_text_of(element))
+                element.clear()
+    return strings
+
+def _find_sheet_path(package, worksheet_name):
+    # Map sheet names to their part paths through workbook.xml and its rels
+    with package.open('xl/workbook.xml') as workbook:
+        sheets = [(sheet.get('name'), sheet.get(f'{REL_NS}id'))
+                  for _, sheet in iterparse(workbook) if sheet.tag == f'{MAIN_NS}sheet']
+    with package.open('xl/_rels/workbook.xml.rels') as rels:
+        targets = {rel.get('Id'): rel.get('Target')
+                   for _, rel in iterparse(rels) if rel.tag == f'{PACKAGE_REL_NS}Relationship'}
+
+    rel_id = sheets[0][1]
+    for name, sheet_rel_id in sheets:
+        if name == worksheet_name:
+            rel_id = sheet_rel_id
+            break
+
+    target = targets[rel_id]
+    if target.startswith('/'):
+        return target.lstrip('/')
+    return posixpath.normpath(posixpath.join('xl', target))
+
+def _cell_position(reference):
+    # 'BN12' -> (66, 12)
+    letters = reference.rstrip('0123456789')
+    column = _COLUMNS.get(letters)
+    if column is None:
+        column = 0
+        for letter in letters:
+            column = column * 26 + ord(letter) - 64
+        _COLUMNS[letters] = column
+    return column, int(reference[len(letters):])
+
+def _cell_value(element, shared_strings):
+    cell_type = element.get('t', 'n')
+
+    if cell_type == 'inlineStr':
+        inline = element.find(f'{MAIN_NS}is')
+        return _text_of(inline) if inline is not None else ''
+
+    raw = element.findtext(f'{MAIN_NS}v')
+    if raw is None:
+        return ''
+    if cell_type == 's':
+        return shared_strings[int(raw)]
+    if cell_type == 'b':
+        return raw == '1'
+    if cell_type in ('str', 'e'):
+        return raw
+    return _number(raw)
+
+def _number(raw):
+    try:
+        return int(raw)
+    except ValueError:
+        value = float(raw)
+        return int(value) if value.is_integer() else value
+
+def _text_of(element):
+    # Concatenate the plain and rich-text runs of a string item,
+    # skipping phonetic (rPh) runs
+    return ''.join(text.text or ''
+                   for child in element if child.tag in (f'{MAIN_NS}t', f'{MAIN_NS}r')
+                   for text in child.iter(f'{MAIN_NS}t'))
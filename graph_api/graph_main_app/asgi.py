@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'graph_main_app.settings')
+# Route the Graph-bound views to their async versions
+os.environ.setdefault('GRAPH_ASYNC_VIEWS', '1')
 
 application = get_asgi_application()